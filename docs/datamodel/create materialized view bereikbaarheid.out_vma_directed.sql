@@ -7,6 +7,7 @@ netwerk.target,
 ST_LineMerge(netwerk.geom)::geometry(LineString,28992) as geom,
 ST_LineMerge(st_transform(geom,4326))::geometry(LineString,4326) as geom4326,
 ST_LineMerge(ST_SnapToGrid(st_transform(ST_SimplifyPreserveTopology(geom,3),4326),0.00001))::geometry(LineString,4326)  as geom4326simply,
+ST_LineMerge(ST_SnapToGrid(st_transform(ST_SimplifyPreserveTopology(geom,10),4326),0.00001))::geometry(LineString,4326)  as geom4326overview,
 netwerk.cost,
 netwerk.binnen_amsterdam,
 netwerk.milieuzone,
@@ -4,6 +4,8 @@ v.name,
 v.anode::int as source,
 v.bnode::int as target,
 v.geom,
+ST_SnapToGrid(st_transform(ST_SimplifyPreserveTopology(v.geom,3),4326),0.00001) as geom4326simply,
+ST_SnapToGrid(st_transform(ST_SimplifyPreserveTopology(v.geom,10),4326),0.00001) as geom4326overview,
 wegtype_ab,
 wegtype_ba,
 st_length(v.geom) as lengte,
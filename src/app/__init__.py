@@ -27,12 +27,54 @@ def create_app():
     app.config["DB_HOST"] = os.environ.get("DB_HOST")
     app.config["DB_PORT"] = os.environ.get("DB_PORT")
     app.config["DB_SSL"] = os.environ.get("DB_SSL")
+    app.config["DB_POOL_MIN"] = int(os.environ.get("DB_POOL_MIN") or 1)
+    app.config["DB_POOL_MAX"] = int(os.environ.get("DB_POOL_MAX") or 4)
+    app.config["DB_POOL_TIMEOUT"] = float(
+        os.environ.get("DB_POOL_TIMEOUT") or 30
+    )
+    app.config["CACHE_TTL"] = int(os.environ.get("CACHE_TTL") or 3600)
+    app.config["CACHE_STALE_TTL"] = int(
+        os.environ.get("CACHE_STALE_TTL") or 3600
+    )
+    app.config["CACHE_DIR"] = os.environ.get("CACHE_DIR")
+    app.config["CACHE_BACKEND"] = os.environ.get("CACHE_BACKEND") or "memory"
+    app.config["CACHE_MAX_SIZE"] = int(os.environ.get("CACHE_MAX_SIZE") or 256)
+    app.config["DATA_VERSION_INTERVAL"] = int(
+        os.environ.get("DATA_VERSION_INTERVAL") or 60
+    )
+    app.config["GEOJSON_STREAMING"] = (
+        os.environ.get("GEOJSON_STREAMING", "").lower() == "true"
+    )
+    app.config["OBSTRUCTIONS_PREWARM_DAYS"] = int(
+        os.environ.get("OBSTRUCTIONS_PREWARM_DAYS") or 0
+    )
+    app.config["ROUTING_SNAPSHOT_DIR"] = os.environ.get("ROUTING_SNAPSHOT_DIR")
+    app.config["WARMUP"] = os.environ.get("WARMUP", "").lower() == "true"
 
     # register database commands
     from . import db
 
     db.init_app(app)
 
+    from . import cache
+
+    cache.init_app(app)
+
+    # track changes of the data, for invalidating the caches
+    from . import data_version
+
+    data_version.init_app(app)
+
+    # register routing commands
+    from . import routing
+
+    routing.init_app(app)
+
+    # warm up the caches of each worker
+    from . import warmup
+
+    warmup.init_app(app)
+
     app.register_blueprint(api_blueprint, url_prefix="/v1")
     app.register_blueprint(status_blueprint, url_prefix="/status")
 
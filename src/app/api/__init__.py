@@ -10,6 +10,7 @@ from . import road_elements  # noqa: E402
 from . import road_obstructions  # noqa: E402
 from .road_sections import load_unload  # noqa: E402
 from . import traffic_signs  # noqa: E402
+from . import tiles  # noqa: E402
 
 
 # Return validation errors as JSON
@@ -9,7 +9,9 @@ from webargs.flaskparser import use_args
 
 from .validation import bbox_adam, days_of_the_week_abbreviated
 from . import api
-from ..db import get_db, query_db
+from .geojson import feature_collection_response
+from ..db import query_db
+from ..routing import get_bollard_network, get_spatial_index
 
 
 class BollardsValidationSchema(Schema):
@@ -78,17 +80,13 @@ def bollards(args):
         args["timeTo"] if "timeTo" in args else None,
     )
 
-    # https://datatracker.ietf.org/doc/html/rfc7946#section-3.3
-    return {
-        "type": "FeatureCollection",
-        "features": [i[0] for i in result] if result else [],
-    }
+    return feature_collection_response(result)
 
 
 def query_db_bollards(day_of_the_week, lat, lon, time_from, time_to):
     """
-    The query calculates a route to the provided lat/lon and returns
-    the encountered bollards. If no bollards are found, nothing is returned.
+    Calculates a route to the provided lat/lon and returns the
+    encountered bollards. If no bollards are found, nothing is returned.
 
     It works as follows:
     - Based on the provided day of the week, start and end time,
@@ -108,9 +106,15 @@ def query_db_bollards(day_of_the_week, lat, lon, time_from, time_to):
     - By recalculating the cost - as described above - the routing algorithm
       will try to find a route without bollards. It will only use routes
       with bollard(s) if all other options are exhausted.
-    - The provided lat/lon is used to search for the closest target node
+    - The provided lat/lon is snapped to the closest road element, the
+      target node of the road element is used as closest target node
     - The closest target node is used for calculating routes
 
+    The route is calculated in process with the bollard network of
+    routing.bollards, with an A* search towards the target node on the
+    cost network of the day of the week and time buckets. The database
+    only looks up the bollards.
+
     :param day_of_the_week: e.g "di"
     :type day_of_the_week: string or None
     :param time_from: e.g "08:00:00"
@@ -125,177 +129,66 @@ def query_db_bollards(day_of_the_week, lat, lon, time_from, time_to):
              on a given day, start and end time.
     """
     db_query = """
-        with bollards as (
-            select pp.*
-            from pgr_dijkstra(
-                %(pgr_dijkstra_cost_query)s,
-                902205,
-                (
-                    select target
-                    from bereikbaarheid.out_vma_directed a
-                    where cost > 0 or car_network is false
-                    order by st_length(
-                        st_transform(
-                            st_shortestline(
-                                st_setsrid(
-                                    ST_MakePoint(%(lon)s, %(lat)s),
-                                    4326
-                                ),
-                                st_linemerge(a.geom4326)
-                            ),
-                            28992
-                        )
-                    ) asc
-                    limit 1
-                )
-            ) as routing
-
-            left join bereikbaarheid.out_vma_directed g
-            on g.id = routing.edge
-
-            left join bereikbaarheid.bd_verkeerspalen pp
-            on abs(routing.edge) = pp.linknr
-            where paalnummer is not null
-            and (
-                (
-                    %(day_of_the_week)s <> ANY(dagen)
-                    or %(day_of_the_week)s is null
-                )
-                and (%(time_from)s <= begin_tijd or %(time_from)s is null)
-                and (%(time_to)s <= eind_tijd or %(time_to)s is null)
-            )
-
-            order by seq
-        )
-
         select json_build_object(
-            'geometry', ST_Transform(bollards.geometry, 4326)::json,
+            'geometry', ST_Transform(pp.geometry, 4326)::json,
             'properties', json_build_object(
-                'id', bollards.paalnummer,
-                'type', bollards.type,
-                'location', bollards.standplaats,
-                'days', bollards.dagen,
-                'start_time', bollards.begin_tijd,
-                'end_time', bollards.eind_tijd,
-                'entry_system', bollards.toegangssysteem
+                'id', pp.paalnummer,
+                'type', pp.type,
+                'location', pp.standplaats,
+                'days', pp.dagen,
+                'start_time', pp.begin_tijd,
+                'end_time', pp.eind_tijd,
+                'entry_system', pp.toegangssysteem
             ),
             'type', 'Feature'
         )
-        from bollards
+        from unnest(%(route)s::bigint[]) with ordinality as routing(edge, seq)
+
+        inner join bereikbaarheid.bd_verkeerspalen pp
+        on abs(routing.edge) = pp.linknr
 
         -- the "or parameter_name is null" makes sure the bollards are
         -- returned when the optional parameters are not present
-        where (
-                %(day_of_the_week)s <> ANY(bollards.dagen)
+        where pp.paalnummer is not null
+            and (
+                %(day_of_the_week)s <> ANY(pp.dagen)
                 or %(day_of_the_week)s is null
             )
-            and (%(time_from)s <= bollards.begin_tijd or %(time_from)s is null)
-            and (%(time_to)s <= bollards.eind_tijd or %(time_to)s is null)
+            and (%(time_from)s <= pp.begin_tijd or %(time_from)s is null)
+            and (%(time_to)s <= pp.eind_tijd or %(time_to)s is null)
+
+        order by routing.seq
     """
 
     query_params = {
         "day_of_the_week": day_of_the_week,
-        "pgr_dijkstra_cost_query": prepare_pgr_dijkstra_cost_query(
-            day_of_the_week, time_from, time_to
-        ),
-        "lat": lat,
-        "lon": lon,
         "time_from": time_from,
         "time_to": time_to,
     }
 
     try:
-        return query_db(db_query, query_params)
-
-    except Exception:
-        print("Error while retrieving bollards")
-
-
-def prepare_pgr_dijkstra_cost_query(day_of_the_week, time_from, time_to):
-    """
-    Helper function for the query_db_bollards function
-    Prepares a database query for use in the pgr_dijkstraCost db function
+        network = get_bollard_network()
+        spatial_index = get_spatial_index()
 
-    This preparation is needed because the pgr_dijkstraCost db function uses
-    psycopg placeholders. When defining this query inline - in the db_query
-    variable of the query_db_bollards function above - the %(time_to)s and
-    %(time_from)s placeholders cause a SQL syntax error (because the date's
-    are single-quoted within a single quoted statement). Therefore this query
-    is prepared first, and returned for use as a query parameter in the
-    query_db_bollards function.
-
-    :param day_of_the_week: string - e.g "di"
-    :param time_from: string - e.g "08:00:00"
-    :param time_to: string - e.g "16:00:00"
-    :return: prepared db query for use in the pgr_dijkstraCost db function
-    """
-
-    pgr_dijkstra_cost_query = """
-        select v.id,
-            v.source,
-            v.target,
-            v.car_network,
-            v.geom,
-
-            case
-                -- cars are allowed AND bollard is blocked
-                when car_network = true
-                    and (
-                        %(day_of_the_week)s <> ANY(dagen)
-                        or %(time_from)s <= begin_tijd
-                        or %(time_to)s >= eind_tijd
-                    )
-                    then cost * 10000
-
-                -- cars are not allowed AND bollard is blocked
-                when car_network = false
-                    and (
-                        %(day_of_the_week)s <> ANY(dagen)
-                        or %(time_from)s <= begin_tijd
-                        or %(time_to)s >= eind_tijd
-                    )
-                    then 10000 * 10000 * 2
-
-                -- cars are allowed AND bollard is open
-                when car_network = true and p.paalnummer is not null
-                    then cost * 10000
-
-                -- cars are not allowed AND bollard is open
-                when car_network = false and p.paalnummer is not null
-                    then 10000 * 10000
-
-                -- cars are not allowed, road section cost is -1
-                when car_network = false
-                    then 10000 * 10000
-
-                -- cars are allowed AND bollard is open
-                else cost
-            end as cost,
-
-            p.paalnummer,
-            p.dagen,
-            p.begin_tijd,
-            p.eind_tijd,
-            p.geometry
+        # the closest road element which can be routed to
+        snap = spatial_index.nearest_edge(
+            lat, lon, network.has_destination(spatial_index.edge_ids)
+        )
 
-            from bereikbaarheid.out_vma_directed v
+        if snap is None:
+            return []
 
-            left join bereikbaarheid.bd_verkeerspalen p
-            on abs(v.id) = abs(p.linknr)
-            where car_network = true
-            or abs(id) in (
-                select linknr from bereikbaarheid.bd_venstertijdwegen
-            )
-        """
+        query_params["route"] = network.route(
+            network.destination_node(snap.id),
+            day_of_the_week,
+            time_from,
+            time_to,
+        )
 
-    pgr_dijkstra_cost_query_params = {
-        "day_of_the_week": day_of_the_week,
-        "time_from": time_from,
-        "time_to": time_to,
-    }
+        if not query_params["route"]:
+            return []
 
-    cursor = get_db().cursor()
+        return query_db(db_query, query_params, raw_json=True)
 
-    return cursor.mogrify(
-        pgr_dijkstra_cost_query, pgr_dijkstra_cost_query_params
-    ).decode("utf-8")
+    except Exception:
+        print("Error while retrieving bollards")
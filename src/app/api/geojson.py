@@ -0,0 +1,211 @@
+from flask import current_app, request, stream_with_context
+from psycopg2 import sql
+
+#
+# Helper functions for GeoJSON responses
+#
+
+# Line geometries are simplified below these zoom levels. The tolerances
+# (in meters) are the ones of the geom4326simply and geom4326overview
+# columns of the out_vma_directed and out_vma_undirected views.
+SIMPLIFIED_ZOOM = 16
+SIMPLIFIED_TOLERANCE = 3
+OVERVIEW_ZOOM = 14
+OVERVIEW_TOLERANCE = 10
+
+
+def feature_collection_chunks(rows, batch_size=1000, meta=None):
+    """
+    Serializes query results to a GeoJSON FeatureCollection
+    https://datatracker.ietf.org/doc/html/rfc7946#section-3.3
+    :param rows: iterable of rows with a Feature as first column, or None.
+        Features fetched with raw_json are used as is.
+    :param batch_size: number of features per chunk
+    :param meta: dict - optional, added as "meta" member of the
+        FeatureCollection
+    :return: generator of strings which together form the JSON document
+    """
+    if meta is None:
+        yield '{"type": "FeatureCollection", "features": ['
+    else:
+        yield (
+            '{"type": "FeatureCollection", "meta": '
+            + current_app.json.dumps(meta)
+            + ', "features": ['
+        )
+
+    separator = ""
+    batch = []
+
+    for row in rows or []:
+        feature = row[0]
+
+        if not isinstance(feature, str):
+            feature = current_app.json.dumps(feature)
+
+        batch.append(feature)
+
+        if len(batch) == batch_size:
+            yield separator + ",".join(batch)
+            separator = ","
+            batch = []
+
+    if batch:
+        yield separator + ",".join(batch)
+
+    yield "]}"
+
+
+def feature_collection_response(rows, on_complete=None, meta=None):
+    """
+    Creates a response with a GeoJSON FeatureCollection. Results of
+    db.query_db_stream are streamed to the client in chunks, all other
+    results are sent at once.
+    :param rows: iterable of rows with a Feature as first column, or None
+    :param on_complete: function - called with the complete body, once
+        all features are serialized. Optional, e.g. for caching the body.
+    :param meta: dict - optional, see feature_collection_chunks
+    :return: Flask response
+    """
+    chunks = feature_collection_chunks(rows, meta=meta)
+
+    if rows is None or isinstance(rows, list):
+        body = "".join(chunks)
+
+        if on_complete:
+            on_complete(body)
+
+        return current_app.response_class(body, mimetype="application/json")
+
+    def stream():
+        body = []
+
+        for chunk in chunks:
+            if on_complete:
+                body.append(chunk)
+
+            yield chunk
+
+        if on_complete:
+            on_complete("".join(body))
+
+    return current_app.response_class(
+        stream_with_context(stream()), mimetype="application/json"
+    )
+
+
+def conditional_response(body, etag, last_modified):
+    """
+    Creates a JSON response which clients revalidate with a conditional
+    request, answered with 304 Not Modified if their version is current
+    :param body: string - the JSON document, or None if the client has
+        the current version already
+    :param etag: string - version of the document
+    :param last_modified: datetime - optional, time of the version
+    :return: Flask response
+    """
+    response = current_app.response_class(
+        body or "", mimetype="application/json"
+    )
+    response.set_etag(etag)
+
+    if last_modified is not None:
+        response.last_modified = last_modified
+
+    response.cache_control.no_cache = True
+
+    if body is None:
+        response.status_code = 304
+        response.data = b""
+        return response
+
+    return response.make_conditional(request)
+
+
+def simplify_tolerance(zoom):
+    """
+    :param zoom: int - zoom level of the map, or None
+    :return: the tolerance in meters for simplifying line geometries at
+        the zoom level, or None for the full resolution
+    """
+    if zoom is None or zoom >= SIMPLIFIED_ZOOM:
+        return None
+
+    if zoom >= OVERVIEW_ZOOM:
+        return SIMPLIFIED_TOLERANCE
+
+    return OVERVIEW_TOLERANCE
+
+
+def line_geometry(
+    zoom, geom, srid=4326, full=None, simplified=None, overview=None
+):
+    """
+    Creates the SQL expression for a line geometry at the resolution of a
+    zoom level. Precomputed geometry columns are used when available.
+    :param zoom: int - zoom level of the map, or None for full resolution
+    :param geom: string - the full resolution geometry in EPSG:28992
+    :param srid: int - the spatial reference of the result
+    :param full: string - optional, geom in srid
+    :param simplified: string - optional, geom in srid simplified with
+        SIMPLIFIED_TOLERANCE
+    :param overview: string - optional, geom in srid simplified with
+        OVERVIEW_TOLERANCE
+    :return: psycopg2.sql.Composable - the expression
+    """
+    tolerance = simplify_tolerance(zoom)
+
+    if tolerance is None and full:
+        return sql.SQL(full)
+
+    if tolerance == SIMPLIFIED_TOLERANCE and simplified:
+        return sql.SQL(simplified)
+
+    if tolerance == OVERVIEW_TOLERANCE and overview:
+        return sql.SQL(overview)
+
+    expression = sql.SQL(geom)
+
+    if tolerance is not None:
+        expression = sql.SQL("ST_SimplifyPreserveTopology({}, {})").format(
+            expression, sql.Literal(tolerance)
+        )
+
+    if srid == 28992:
+        return expression
+
+    expression = sql.SQL("ST_Transform({}, {})").format(
+        expression, sql.Literal(srid)
+    )
+
+    if tolerance is not None:
+        # like the precomputed columns, coordinates are rounded to about a
+        # meter
+        expression = sql.SQL("ST_SnapToGrid({}, 0.00001)").format(expression)
+
+    return expression
+
+
+def bbox_filter(bbox, geom, srid=4326):
+    """
+    Creates the SQL condition which limits features to those intersecting
+    a bounding box
+    :param bbox: list - min lon, min lat, max lon, max lat (WGS84), or None
+    :param geom: string - the geometry of the features
+    :param srid: int - the spatial reference of geom
+    :return: psycopg2.sql.Composable - the condition, starting with 'and',
+        or an empty string if there is no bounding box
+    """
+    if bbox is None:
+        return sql.SQL("")
+
+    envelope = sql.SQL("ST_MakeEnvelope({}, 4326)").format(
+        sql.SQL(", ").join(sql.Literal(float(i)) for i in bbox)
+    )
+
+    if srid != 4326:
+        envelope = sql.SQL("ST_Transform({}, {})").format(
+            envelope, sql.Literal(srid)
+        )
+
+    return sql.SQL("and ST_Intersects({}, {})").format(sql.SQL(geom), envelope)
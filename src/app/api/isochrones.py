@@ -1,12 +1,49 @@
-from flask import jsonify
+from flask import current_app
 from marshmallow import Schema, fields, validate
+import numpy as np
+from psycopg2 import sql
+from webargs.fields import DelimitedList
 from webargs.flaskparser import use_args
 from . import api
-from .validation import bbox_adam
+from .geojson import (
+    feature_collection_response,
+    line_geometry,
+    simplify_tolerance,
+)
+from .validation import bbox_adam, zoom_levels
+from ..cache import Cache
 from ..db import query_db
+from ..routing import get_graph, get_spatial_index
+
+
+# Isochrone polygons are the road elements reached within a cutoff,
+# buffered and simplified with these distances (in meters)
+POLYGON_BUFFER = 50
+POLYGON_TOLERANCE = 5
+
+# Maximum number of cutoffs and the maximum cutoff (in minutes)
+MAX_CUTOFFS = 10
+MAX_CUTOFF_MINUTES = 120
+
+# Serialized isochrones, keyed by the node closest to the location and
+# the cutoffs or the simplification of the road elements
+isochrones_cache = Cache(
+    "isochrones",
+    maxsize=256,
+    tables=["out_vma_directed", "out_vma_node", "out_vma_undirected"],
+    shared=True,
+)
 
 
 class IsochronesValidationSchema(Schema):
+    # travel times in minutes, returns a polygon per cutoff instead of
+    # the road elements with their travel time
+    cutoffs = DelimitedList(
+        fields.Integer(validate=validate.Range(min=1, max=MAX_CUTOFF_MINUTES)),
+        required=False,
+        validate=validate.Length(min=1, max=MAX_CUTOFFS),
+    )
+
     lat = fields.Float(
         required=True,
         validate=[
@@ -25,61 +62,170 @@ class IsochronesValidationSchema(Schema):
         ],
     )
 
+    # only road elements within this travel time are returned, the
+    # search for routes stops at this travel time
+    maxMinutes = fields.Integer(
+        required=False,
+        validate=validate.Range(min=1, max=MAX_CUTOFF_MINUTES),
+    )
+
+    zoom = fields.Integer(
+        required=False,
+        validate=[
+            validate.Range(min=zoom_levels["min"], max=zoom_levels["max"])
+        ],
+    )
+
 
 @api.route("/roads/isochrones")
 @use_args(IsochronesValidationSchema(), location="query")
 def isochrones(args):
-    return jsonify(query_db_isochrones(args["lat"], args["lon"]))
+    # isochrones only depend on the node closest to the location, which
+    # is included in the response so clients can recognize equal results
+    try:
+        node_id = get_spatial_index().nearest_node(args["lat"], args["lon"]).id
+    except Exception:
+        print("Error while retrieving isochrones")
+        return feature_collection_response(None)
 
+    meta = {"node_id": node_id}
+    max_minutes = args.get("maxMinutes")
 
-def query_db_isochrones(lat, lon):
+    if "cutoffs" in args:
+        cutoffs = sorted(set(args["cutoffs"]))
+        # nothing beyond the largest cutoff is needed
+        max_minutes = min(max_minutes or cutoffs[-1], cutoffs[-1])
+        cache_key = (node_id, max_minutes, "polygons", tuple(cutoffs))
+    else:
+        cache_key = (
+            node_id,
+            max_minutes,
+            "lines",
+            simplify_tolerance(args.get("zoom")),
+        )
+
+    body = isochrones_cache.get(cache_key)
+
+    if body is not None:
+        return current_app.response_class(body, mimetype="application/json")
+
+    if "cutoffs" in args:
+        result = query_db_isochrone_polygons(node_id, cutoffs, max_minutes)
+    else:
+        result = query_db_isochrones(node_id, args.get("zoom"), max_minutes)
+
+    # errors are not cached
+    if result is None:
+        return feature_collection_response(result, meta=meta)
+
+    return feature_collection_response(
+        result, lambda body: isochrones_cache.set(cache_key, body), meta
+    )
+
+
+def query_db_isochrones(node_id, zoom=None, max_minutes=None):
     """
     Queries database for isochrones based on location
-    :param lat: float - the latitude of the location
-    :param lon: float - the longitude of the location
+    :param node_id: int - the node closest to the location
+    :param zoom: int - zoom level of the map, for simplifying the geometry
+    :param max_minutes: int - optional, only road elements within this
+        travel time are returned
     :return: object - isochrones based on location
     """
-
-    # default response
-    # https://datatracker.ietf.org/doc/html/rfc7946#section-3.3
-    response = {"type": "FeatureCollection", "features": []}
-
-    db_query = """
+    db_query = sql.SQL(
+        """
         select json_build_object(
             'type','Feature',
             'properties',json_build_object(
-            'id', abs(sub.id),
-            'totalcost', min(totalcost)::int) ,
+            'id', id,
+            'totalcost', totalcost::int) ,
             'geometry', geom::json
         )
+        from ({road_elements}) road_elements"""
+    ).format(
+        road_elements=isochrones_query(
+            line_geometry(zoom, "a.geom", srid=28992)
+        )
+    )
+
+    try:
+        query_params = isochrones_query_params(node_id, max_minutes)
+
+        return query_db(db_query, query_params, raw_json=True)
+
+    except Exception:
+        print("Error while retrieving isochrones")
+
+
+def query_db_isochrone_polygons(node_id, cutoffs, max_minutes=None):
+    """
+    Queries database for isochrone polygons based on location: the area
+    of the road elements which can be reached within each cutoff
+    :param node_id: int - the node closest to the location
+    :param cutoffs: list of ints - travel times in minutes
+    :param max_minutes: int - optional, the largest cutoff which is needed
+    :return: object - a polygon per cutoff, largest first
+    """
+    db_query = sql.SQL(
+        """
+        select json_build_object(
+            'type','Feature',
+            'properties', json_build_object('cutoff', c.cutoff),
+            'geometry', ST_AsGeoJSON(
+                ST_SimplifyPreserveTopology(
+                    ST_Buffer(ST_Collect(road_elements.geom), %(buffer)s),
+                    %(tolerance)s
+                )
+            )::json
+        )
+        from ({road_elements}) road_elements
+
+        inner join unnest(%(cutoffs)s::int[]) as c(cutoff)
+        on road_elements.totalcost <= c.cutoff * 60
+
+        group by c.cutoff
+        order by c.cutoff desc"""
+    ).format(road_elements=isochrones_query(sql.SQL("a.geom")))
+
+    try:
+        query_params = isochrones_query_params(node_id, max_minutes)
+        query_params.update(
+            {
+                "cutoffs": cutoffs,
+                "buffer": POLYGON_BUFFER,
+                "tolerance": POLYGON_TOLERANCE,
+            }
+        )
+
+        return query_db(db_query, query_params, raw_json=True)
+
+    except Exception:
+        print("Error while retrieving isochrone polygons")
+
+
+def isochrones_query(geometry):
+    """
+    Creates the query for the road elements within Amsterdam with their
+    travel time from the location, in seconds to the middle of the road
+    element (null if unreachable). With max_totalcost (in seconds) only
+    road elements within this travel time are included.
+    :param geometry: psycopg2.sql.Composable - the geometry expression of
+        the road elements (a.geom in EPSG:28992)
+    :return: psycopg2.sql.Composed - the query, with the columns id,
+        totalcost and geom
+    """
+    return sql.SQL(
+        """
+        select abs(sub.id) as id,
+            min(totalcost) as totalcost,
+            {geometry} as geom
         from (
             select id,
             (0.5 * cost+source.agg_cost) * 3600 as totalcost
             from bereikbaarheid.out_vma_directed bebording
 
-            left join (
-                SELECT end_vid, agg_cost
-                FROM pgr_dijkstraCost('
-                    select id, source ,target, cost
-                    from bereikbaarheid.out_vma_directed',
-                    (
-                        select x.node
-                        from (
-                            select node, geom
-                            from bereikbaarheid.out_vma_node
-                        ) as x
-                        order by st_distance(
-                            x.geom,
-                            st_setsrid(ST_MakePoint(%(lon)s, %(lat)s), 4326)
-                        ) asc
-                        limit 1
-                    ),
-                    array(
-                        select node
-                        from bereikbaarheid.out_vma_node
-                    )
-                )
-            ) as source
+            left join unnest(%(nodes)s::bigint[], %(agg_costs)s::float8[])
+                as source(end_vid, agg_cost)
             on source.end_vid =  bebording.source
             where cost > 0
         ) as sub
@@ -90,18 +236,32 @@ def query_db_isochrones(lat, lon):
                 select linknr from bereikbaarheid.out_vma_undirected
                 where binnen_amsterdam is true
             )
+            and (
+                %(max_totalcost)s::float8 is null
+                or sub.totalcost <= %(max_totalcost)s
+            )
 
         group by a.geom, abs(sub.id)"""
+    ).format(geometry=geometry)
 
-    query_params = {"lat": lat, "lon": lon}
-
-    try:
-        result = query_db(db_query, query_params)
 
-        if result:
-            response["features"] = [i[0] for i in result]
+def isochrones_query_params(node_id, max_minutes=None):
+    """
+    Calculates the aggregated cost from the node closest to the location
+    to all other nodes, in one Dijkstra run. With max_minutes the search
+    stops at that travel time, so only the nodes within it are included.
+    :param node_id: int - the node closest to the location
+    :param max_minutes: int - optional, maximum travel time in minutes
+    :return: dict - the parameters used by isochrones_query
+    """
+    graph = get_graph()
 
-    except Exception:
-        print("Error while retrieving isochrones")
+    # the cost of the road elements is in hours
+    limit = max_minutes / 60 if max_minutes is not None else np.inf
+    nodes, agg_costs = graph.agg_costs(node_id, graph.routable(), limit)
 
-    return response
+    return {
+        "nodes": nodes.tolist(),
+        "agg_costs": agg_costs.tolist(),
+        "max_totalcost": max_minutes * 60 if max_minutes is not None else None,
+    }
@@ -5,6 +5,11 @@ from . import api
 from .validation import bbox_adam, vehicle, allowed_vehicle_types
 from . import vehicleTypes
 from ..db import query_db
+from ..routing import get_graph, get_spatial_index
+
+# Maximum number of locations and vehicles of a batch request
+PERMITS_BATCH_MAX_DESTINATIONS = 1000
+PERMITS_BATCH_MAX_VEHICLES = 10
 
 
 class PermitsValidationSchema(Schema):
@@ -97,7 +102,29 @@ class PermitsValidationSchema(Schema):
     )
 
 
-@api.route("/permits")
+class PermitsBatchValidationSchema(Schema):
+    destinations = fields.List(
+        fields.Nested(PermitsValidationSchema(only=["lat", "lon"])),
+        required=True,
+        validate=validate.Length(min=1, max=PERMITS_BATCH_MAX_DESTINATIONS),
+    )
+
+    vehicles = fields.List(
+        fields.Nested(PermitsValidationSchema(exclude=["lat", "lon"])),
+        required=True,
+        validate=validate.Length(min=1, max=PERMITS_BATCH_MAX_VEHICLES),
+    )
+
+
+# https://jsonapi.org/format/#error-objects
+database_error = {
+    "status": 500,
+    "title": "database error",
+    "detail": "no connection or error in query",
+}
+
+
+@api.get("/permits")
 @use_args(PermitsValidationSchema(), location="query")
 def permits(args):
     return jsonify(
@@ -118,6 +145,14 @@ def permits(args):
     )
 
 
+@api.post("/permits")
+@use_args(PermitsBatchValidationSchema(), location="json")
+def permits_batch(args):
+    return jsonify(
+        query_db_permits_batch(args["vehicles"], args["destinations"])
+    )
+
+
 def query_db_permits(
     vehicle_type,
     vehicle_length,
@@ -155,8 +190,126 @@ def query_db_permits(
     # https://jsonapi.org/format/
     response = {"data": None, "errors": [], "meta": {}}
 
+    try:
+        result = query_db_destination_permits(
+            vehicle_type,
+            vehicle_length,
+            vehicle_width,
+            vehicle_has_trailer,
+            vehicle_height,
+            vehicle_axle_weight,
+            vehicle_total_weight,
+            vehicle_max_allowed_weight,
+            permit_low_emission_zone,
+            permit_zzv,
+            [(lat, lon)],
+            snap_locations([(lat, lon)]),
+        )
+
+        if result:
+            response["data"] = result[0][1]
+
+    except Exception:
+        response["errors"].append(database_error)
+
+    return response
+
+
+def query_db_permits_batch(vehicles, destinations):
+    """
+    Queries database for the permits of several vehicles at several
+    locations. The reachability is calculated once per vehicle.
+    :param vehicles: list of dicts - vehicle properties and permits, see
+        PermitsBatchValidationSchema
+    :param destinations: list of dicts - lat and lon of the locations
+    :return: object - permits per vehicle and location. The vehicle and
+        destination of each permit are included as indexes in its meta
+        object. Locations without a road element in Amsterdam are left out.
+    """
+
+    # default response
+    # https://jsonapi.org/format/
+    response = {"data": [], "errors": [], "meta": {}}
+
+    locations = [(i["lat"], i["lon"]) for i in destinations]
+
+    # the road element of a location is the same for every vehicle
+    try:
+        road_element_ids = snap_locations(locations)
+    except Exception:
+        response["errors"].append(database_error)
+        return response
+
+    for vehicle_index, profile in enumerate(vehicles):
+        try:
+            result = query_db_destination_permits(
+                profile["vehicleType"],
+                profile["vehicleLength"],
+                profile["vehicleWidth"],
+                profile["vehicleHasTrailer"],
+                profile["vehicleHeight"],
+                profile["vehicleAxleWeight"],
+                profile["vehicleTotalWeight"],
+                profile["vehicleMaxAllowedWeight"],
+                profile["permitLowEmissionZone"],
+                profile["permitZzv"],
+                locations,
+                road_element_ids,
+            )
+
+        except Exception:
+            response["errors"].append(
+                dict(database_error, meta={"vehicle": vehicle_index})
+            )
+            continue
+
+        for destination_index, permit in result:
+            permit["meta"] = {
+                "destination": destination_index,
+                "vehicle": vehicle_index,
+            }
+            response["data"].append(permit)
+
+    return response
+
+
+def snap_locations(locations):
+    """
+    :param locations: list of tuples - lat, lon of each location
+    :return: list of ints - the id of the road element closest to each
+        location
+    """
+    spatial_index = get_spatial_index()
+
+    return [spatial_index.nearest_edge(lat, lon).id for lat, lon in locations]
+
+
+def query_db_destination_permits(
+    vehicle_type,
+    vehicle_length,
+    vehicle_width,
+    vehicle_has_trailer,
+    vehicle_height,
+    vehicle_axle_weight,
+    vehicle_total_weight,
+    vehicle_max_allowed_weight,
+    permit_low_emission_zone,
+    permit_zzv,
+    locations,
+    road_element_ids,
+):
+    """
+    Helper function for query_db_permits and query_db_permits_batch
+    Queries database for the permits of a vehicle at one or more locations
+    See query_db_permits for the description of the vehicle parameters
+    :param locations: list of tuples - lat, lon of each location
+    :param road_element_ids: list of ints - the road element closest to
+        each location, see snap_locations
+    :return: list of tuples - index of the location and its permits, for
+        the locations with a road element in Amsterdam
+    """
     db_query = """
-        select json_build_object(
+        select destination, json_build_object(
             'id', id,
             'attributes',json_build_object(
                 'heavy_goods_vehicle_zone', zone_7_5_boolean::boolean,
@@ -170,7 +323,7 @@ def query_db_permits(
             )
         )
         from (
-            select v.id,
+            select distinct on (d.destination) d.destination, v.id,
             case
                 when v.milieuzone = false and %(permit_zone_milieu)s = false
                     then 'false'
@@ -205,18 +358,10 @@ def query_db_permits(
                 else 'true'
             end as boolean_in_amsterdam,
 
-            ST_closestpoint(
-                v.geom,st_setsrid(ST_MakePoint(%(lon)s, %(lat)s), 4326)
-            ) as geom,
+            ST_closestpoint(v.geom, d.geom) as geom,
 
             st_length(
-                st_transform(
-                    st_shortestline(
-                        v.geom,
-                        st_setsrid(ST_MakePoint(%(lon)s, %(lat)s), 4326)
-                    ),
-                    28992
-                )
+                st_transform(st_shortestline(v.geom, d.geom), 28992)
             ) as afstand_in_m,
 
             ven.dagen as venstertijd,
@@ -229,12 +374,24 @@ def query_db_permits(
             end as zone_7_5_detail
 
             from (
+                select destination,
+                    road_element_id,
+                    st_setsrid(ST_MakePoint(lon, lat), 4326) as geom
+                from unnest(
+                    %(lats)s::float8[],
+                    %(lons)s::float8[],
+                    %(road_element_ids)s::bigint[]
+                ) with ordinality
+                    as destinations(lat, lon, road_element_id, destination)
+            ) d
+
+            join (
                 select
                     abs(n.id) as id,
                     max(
                         case
                             when n.cost is NULL then 333
-                            when routing.agg_cost is null then 222
+                            when unreachable.node is not null then 222
                             when n.c07 is true and %(bedrijfsauto)s is true
                                 and %(max_massa)s > 3500
                                 or n.c07a is true and %(bus)s is true
@@ -253,43 +410,8 @@ def query_db_permits(
                     g.zone_7_5,
                     g.milieuzone
                 from bereikbaarheid.out_vma_directed n
-                left join (
-                    SELECT start_vid as source,
-                    end_vid as target,
-                    agg_cost FROM pgr_dijkstraCost('
-                        select id, source, target, cost
-                        from bereikbaarheid.out_vma_directed
-                        where (%(lengte)s < c17 or c17 is null)
-                        and (%(breedte)s < c18 or c18 is null)
-                        and (%(hoogte)s < c19 or c19 is null)
-                        and (%(aslast)s < c20 or c20 is null)
-                        and (%(gewicht)s < c21 or c21 is null)
-                        and (c01 is false)
-                        and (
-                                c07 is false
-                                or (c07 is true and %(bedrijfsauto)s is false)
-                                or (
-                                    c07 is true
-                                    and %(bedrijfsauto)s is true
-                                    and %(max_massa)s <= 3500
-                                )
-                            )
-                            and (
-                                c07a is false
-                                or (c07a is true and %(bus)s is false)
-                            )
-                            and (
-                                c10 is false
-                                or (c10 is true and %(aanhanger)s is false)
-
-                        )',
-                        902205,
-                        array(
-                            select node
-                            from bereikbaarheid.out_vma_node
-                        )
-                    )
-                ) as routing on n.source=routing.target
+                left join unnest(%(unreachable_nodes)s::bigint[])
+                    as unreachable(node) on n.source = unreachable.node
 
                 left join bereikbaarheid.out_vma_directed g
                     on abs(n.id) = g.id
@@ -298,35 +420,32 @@ def query_db_permits(
                         where binnen_amsterdam is true and id > 0
                     )
                     and n.cost > 0
+                    and abs(n.id) = any(%(road_element_ids)s::bigint[])
 
                 group by abs(n.id), g.geom4326,g.zone_7_5, g.milieuzone
-                order by abs(n.id)) v
+                ) v
+                on v.id = d.road_element_id
 
                 left join bereikbaarheid.bd_venstertijdwegen as ven
                 on v.id = abs(ven.linknr)
 
                 left join bereikbaarheid.out_vma_undirected as tiles
                     on v.id=tiles.linknr
-                    where v.id = (
-                        SELECT id
-                        from bereikbaarheid.out_vma_directed a
-                        where id > 0
-                        order by st_length(
-                            st_transform(
-                                st_shortestline(
-                                    st_setsrid(
-                                        ST_MakePoint(%(lon)s, %(lat)s),
-                                        4326
-                                    ),
-                                    st_linemerge(a.geom4326)
-                                ),
-                                28992
-                            )
-                        ) asc
-                        limit 1
-                    )
+
+            order by d.destination
         ) m """
 
+    vehicle = vehicleTypes.routing_vehicle(
+        vehicle_type,
+        vehicle_length,
+        vehicle_width,
+        vehicle_has_trailer,
+        vehicle_height,
+        vehicle_axle_weight,
+        vehicle_total_weight,
+        vehicle_max_allowed_weight,
+    )
+
     query_params = {
         "bedrijfsauto": vehicleTypes.vehicle_is_company_car(vehicle_type),
         "bus": vehicleTypes.vehicle_is_bus(vehicle_type),
@@ -339,23 +458,15 @@ def query_db_permits(
         "max_massa": vehicle_max_allowed_weight,
         "permit_zone_milieu": permit_low_emission_zone,
         "permit_zone_7_5": permit_zzv,
-        "lat": lat,
-        "lon": lon,
+        "lats": [lat for lat, lon in locations],
+        "lons": [lon for lat, lon in locations],
+        "road_element_ids": road_element_ids,
     }
 
-    try:
-        result = query_db(db_query, query_params, True)
+    graph = get_graph()
+    query_params["unreachable_nodes"] = graph.class_unreachable_nodes(
+        graph.vehicle_class(vehicle)
+    ).tolist()
 
-        if result:
-            response["data"] = result[0]
-
-    except Exception:
-        response["errors"].append(
-            {
-                "status": 500,
-                "title": "database error",
-                "detail": "no connection or error in query",
-            }
-        )
-
-    return response
+    # with ordinality starts counting at 1
+    return [(i[0] - 1, i[1]) for i in query_db(db_query, query_params)]
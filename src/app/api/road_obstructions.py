@@ -1,14 +1,41 @@
-from datetime import datetime, time
-from marshmallow import Schema, fields, validates_schema, ValidationError
+from datetime import datetime, time, timedelta
+from functools import lru_cache
+import hashlib
+import threading
+from flask import current_app
+from marshmallow import (
+    Schema,
+    fields,
+    validate,
+    validates_schema,
+    ValidationError,
+)
+import numpy as np
+from psycopg2 import sql
 import pytz
+from webargs.fields import DelimitedList
 from webargs.flaskparser import use_args
 from . import api
-from ..db import query_db, get_db
+from .geojson import (
+    bbox_filter,
+    feature_collection_chunks,
+    feature_collection_response,
+    line_geometry,
+    simplify_tolerance,
+)
+from .validation import validate_bbox, zoom_levels
+from ..cache import Cache
+from ..db import query_db, query_db_stream
+from ..routing import get_graph
 
 tz_amsterdam = pytz.timezone("Europe/Amsterdam")
 
 
 class RoadObstructionsValidationSchema(Schema):
+    bbox = DelimitedList(
+        fields.Float(), required=False, validate=validate_bbox
+    )
+
     date = fields.Date(
         format="%Y-%m-%d",
         load_default=lambda: datetime.today().astimezone(tz_amsterdam),
@@ -27,54 +54,315 @@ class RoadObstructionsValidationSchema(Schema):
         required=False,
     )
 
+    zoom = fields.Integer(
+        required=False,
+        validate=[
+            validate.Range(min=zoom_levels["min"], max=zoom_levels["max"])
+        ],
+    )
+
     @validates_schema
     def validate_dates(self, data, **kwargs):
         if data["timeTo"] < data["timeFrom"]:
             raise ValidationError("TimeTo must be later than timeFrom")
 
 
+class ObstructionIndex:
+    """
+    Interval index over the obstructions (bereikbaarheid.bd_stremmingen).
+    The obstructions which are active in a time window only change at the
+    start and end dates of the obstructions (the breakpoints), so windows
+    are mapped to the breakpoints they span, and from there to the set of
+    active obstructions. Windows with the same active obstructions get the
+    same set, which identifies the results for these windows.
+    """
+
+    def __init__(self, road_element_ids, start_dates, end_dates):
+        """
+        :param road_element_ids: list of ints - vma_linknr per obstruction
+        :param start_dates: list of datetimes - start_date per obstruction
+        :param end_dates: list of datetimes - end_date per obstruction
+        """
+        self.road_element_ids = np.array(road_element_ids, dtype=np.int64)
+        self.start_dates = np.array(start_dates, dtype="datetime64[us]")
+        self.end_dates = np.array(end_dates, dtype="datetime64[us]")
+
+        # identifies the obstructions in cache keys, an index which is
+        # reloaded with the same obstructions gets the same version, so
+        # cached responses (also expired ones) remain usable
+        version = hashlib.md5()
+        for array in (self.road_element_ids, self.start_dates, self.end_dates):
+            version.update(array.tobytes())
+        self.version = version.hexdigest()
+
+        dates = np.concatenate((self.start_dates, self.end_dates))
+        self.breakpoints = np.unique(dates[~np.isnat(dates)])
+
+        self._obstructions = lru_cache(1024)(self._active_obstructions)
+
+    def active_obstructions(self, time_from, time_to):
+        """
+        :param time_from: datetime - start of the window
+        :param time_to: datetime - end of the window
+        :return: tuple - indexes of the obstructions which are active at
+            some moment in the window, like the road obstructions query
+        """
+        # obstructions which end before the window or start after it
+        ended = np.searchsorted(
+            self.breakpoints, np.datetime64(time_from, "us"), side="left"
+        )
+        started = np.searchsorted(
+            self.breakpoints, np.datetime64(time_to, "us"), side="right"
+        )
+
+        return self._obstructions(int(ended), int(started))
+
+    def _active_obstructions(self, ended, started):
+        """
+        Results are cached, use active_obstructions to call this.
+        :param ended: int - obstructions ending before this breakpoint
+            index are not active
+        :param started: int - obstructions starting before this
+            breakpoint index are active, if they have not ended
+        :return: tuple - indexes of the active obstructions
+        """
+        with np.errstate(invalid="ignore"):
+            active = (self.start_dates < self.breakpoints_at(started)) & (
+                self.end_dates >= self.breakpoints_at(ended)
+            )
+
+        return tuple(np.flatnonzero(active).tolist())
+
+    def interval_moments(self, time_from, time_to):
+        """
+        The active obstructions only change at the breakpoints, so a
+        period is divided into intervals with the same active obstructions
+        :param time_from: datetime - start of the period
+        :param time_to: datetime - end of the period
+        :return: list of datetimes - a moment in each interval between the
+            breakpoints in the period
+        """
+        start = np.datetime64(time_from, "us")
+        end = np.datetime64(time_to, "us")
+        inside = self.breakpoints[
+            (self.breakpoints > start) & (self.breakpoints < end)
+        ]
+        bounds = np.concatenate(([start], inside, [end]))
+
+        return [
+            (bounds[i] + (bounds[i + 1] - bounds[i]) // 2).item()
+            for i in range(len(bounds) - 1)
+        ]
+
+    def breakpoints_at(self, i):
+        """
+        :param i: int - breakpoint index, may be len(breakpoints)
+        :return: datetime64 - the breakpoint, or the maximum date after
+            the last breakpoint
+        """
+        if i < len(self.breakpoints):
+            return self.breakpoints[i]
+
+        return np.datetime64("9999-12-31T23:59:59.999999", "us")
+
+
+# The obstruction index is reloaded once the cache entry expires, in the
+# background while the expired index is still used
+obstruction_index_cache = Cache(
+    "road_obstruction_index",
+    maxsize=1,
+    tables=["bd_stremmingen"],
+    stale=True,
+)
+
+# Serialized /road-obstructions/ responses, see road_obstructions_cache_key
+road_obstructions_cache = Cache(
+    "road_obstructions",
+    maxsize=256,
+    tables=["bd_stremmingen", "out_vma_directed", "out_vma_undirected"],
+    stale=True,
+    shared=True,
+)
+
+
 @api.get("/road-obstructions/")
 @use_args(RoadObstructionsValidationSchema(), location="query")
 def road_obstructions(args):
     time_from = datetime.combine(args["date"], args["timeFrom"])
     time_to = datetime.combine(args["date"], args["timeTo"])
 
-    result = query_db_road_obstructions(time_from, time_to)
+    # responses for a viewport are not cached, these rarely repeat
+    try:
+        cache_key = (
+            None
+            if "bbox" in args
+            else road_obstructions_cache_key(
+                time_from, time_to, args.get("zoom")
+            )
+        )
+    except Exception:
+        cache_key = None
+
+    if cache_key is None:
+        return feature_collection_response(
+            query_db_road_obstructions(
+                time_from,
+                time_to,
+                args.get("zoom"),
+                args.get("bbox"),
+                current_app.config["GEOJSON_STREAMING"],
+            )
+        )
 
-    # https://datatracker.ietf.org/doc/html/rfc7946#section-3.3
-    return {
-        "type": "FeatureCollection",
-        "features": [i[0] for i in result] if result else [],
-    }
+    body = cached_road_obstructions(
+        current_app._get_current_object(),
+        cache_key,
+        time_from,
+        time_to,
+        args.get("zoom"),
+    )
+
+    # errors are not cached
+    if body is None:
+        return feature_collection_response(None)
+
+    return current_app.response_class(body, mimetype="application/json")
+
+
+def cached_road_obstructions(app, cache_key, time_from, time_to, zoom=None):
+    """
+    Returns the serialized road obstructions from the cache. The response
+    is computed once, also for concurrent requests, and an expired
+    response is served while it is refreshed in the background.
+    :param app: the Flask app
+    :param cache_key: tuple - see road_obstructions_cache_key
+    :param time_from: datetime - start of the window
+    :param time_to: datetime - end of the window
+    :param zoom: int - zoom level of the map
+    :return: string - the GeoJSON FeatureCollection, or None on errors
+    """
+
+    # the rows are fetched in batches with GEOJSON_STREAMING, so only the
+    # serialized response is held in memory as a whole
+    def compute():
+        with app.app_context():
+            result = query_db_road_obstructions(
+                time_from,
+                time_to,
+                zoom,
+                stream=app.config["GEOJSON_STREAMING"],
+            )
+
+            if result is None:
+                return None
+
+            return "".join(feature_collection_chunks(result))
+
+    return road_obstructions_cache.get_or_compute(cache_key, compute)
+
+
+def road_obstructions_cache_key(time_from, time_to, zoom=None, index=None):
+    """
+    Road obstructions only depend on the obstructions which are active in
+    the time window, so windows with the same active obstructions share
+    the cache key
+    :param time_from: datetime - start of the window
+    :param time_to: datetime - end of the window
+    :param zoom: int - zoom level of the map
+    :param index: ObstructionIndex - defaults to the cached index
+    :return: tuple - the cache key
+    """
+    if index is None:
+        index = get_obstruction_index()
+
+    return (
+        index.version,
+        index.active_obstructions(time_from, time_to),
+        simplify_tolerance(zoom),
+    )
 
 
-def query_db_road_obstructions(time_from, time_to):
+def query_db_road_obstructions(
+    time_from, time_to, zoom=None, bbox=None, stream=False
+):
     """
     Queries database for road obstructions for a specific date
     :param time_from: string - e.g "2022-05-29 08:00:00"
     :param time_to: string - e.g "2022-05-29 16:00:00"
+    :param zoom: int - zoom level of the map, for simplifying the geometry
+    :param bbox: list - optional, only road elements intersecting this
+        bounding box (min lon, min lat, max lon, max lat) are returned
+    :param stream: if the results should be fetched in batches
     :return: object - road elements with obstructions
     """
-    db_query = """
+    db_query = sql.SQL(
+        """
         select json_build_object(
-            'geometry', ST_Transform(t1.geom, 4326)::json,
+            'geometry', {geometry}::json,
             'properties', json_build_object(
-                'road_element_id', t1.linknr,
-                'road_element_street_name', t1.name,
-                'road_element_accessibility_code', t2."bereikbaar_status_code",
-                'obstructions', case
-                    when t2."bereikbaar_status_code" = 222 then '[]'
-                    else json_agg(json_build_object(
-                        'activity', t2."werkzaamheden",
-                        'reference', t2."kenmerk",
-                        'url', t2."url",
-                        'start_date', t2.start_date,
-                        'end_date', t2.end_date
-                    ) order by t2.end_date asc)
-                    end
+                'road_element_id', id,
+                'road_element_street_name', name,
+                'road_element_accessibility_code', bereikbaar_status_code,
+                'obstructions', obstructions
             ),
             'type', 'Feature'
         )
+        from ({road_obstructions}) m
+    """
+    ).format(
+        geometry=line_geometry(
+            zoom,
+            "geom",
+            simplified="geom4326simply",
+            overview="geom4326overview",
+        ),
+        road_obstructions=road_obstructions_query(
+            bbox_filter(bbox, "g.geom", 28992)
+        ),
+    )
+
+    try:
+        query_params = road_obstructions_query_params(time_from, time_to)
+
+        if stream:
+            return query_db_stream(db_query, query_params, raw_json=True)
+
+        return query_db(db_query, query_params, raw_json=True)
+
+    except Exception:
+        print("Error while retrieving road obstructions")
+
+
+def road_obstructions_query(road_filter=sql.SQL("")):
+    """
+    The road elements which are obstructed or can't be reached because of
+    obstructions, with their bereikbaar_status_code, the obstructions and
+    the geometry (geom, EPSG:28992, and the simplified geom4326simply and
+    geom4326overview). Used for both the GeoJSON and the
+    vector tile output, with the parameters created by
+    road_obstructions_query_params.
+    :param road_filter: psycopg2.sql.Composable - optional extra condition
+        on the road elements (g), starting with 'and'
+    :return: psycopg2.sql.Composed - the query
+    """
+    return sql.SQL(
+        """
+        select t1.linknr as id,
+            t1.name,
+            t2."bereikbaar_status_code",
+            case
+                when t2."bereikbaar_status_code" = 222 then '[]'
+                else json_agg(json_build_object(
+                    'activity', t2."werkzaamheden",
+                    'reference', t2."kenmerk",
+                    'url', t2."url",
+                    'start_date', t2.start_date,
+                    'end_date', t2.end_date
+                ) order by t2.end_date asc)
+            end as obstructions,
+            t1.geom,
+            t1.geom4326simply,
+            t1.geom4326overview
         from bereikbaarheid.out_vma_undirected t1
 
         right join (
@@ -92,7 +380,7 @@ def query_db_road_obstructions(time_from, time_to):
                     max(
                         case
                             when strem.start_date is not NUll then 333	-- If the link has a startdate, there are werkzaamheden. So it is directly unreachable. # noqa: E501
-                            when routing.agg_cost is null then 222		-- When the aggregating cost is zero the source node of the road is unreachable. # noqa: E501
+                            when unreachable.node is not null then 222		-- When the source node of the road is unreachable. # noqa: E501
                             else 999
                         end
                     ) as bereikbaar_status_code,
@@ -106,20 +394,10 @@ def query_db_road_obstructions(time_from, time_to):
                 from bereikbaarheid.out_vma_directed netwerk
 
                 -- BLOCK 2: FROM, routing
-                -- finds agg_cost to all nodes
-                left join (
-                    SELECT start_vid as source, end_vid as target, agg_cost
-                    FROM pgr_dijkstraCost(
-                        %(pgr_dijkstra_cost_query)s,
-                        902205,
-                        array(
-                            select node
-                            from bereikbaarheid.out_vma_node
-                        ),
-                        directed := true -- because all the roads have been doubled to form an undirected network. # noqa: E501
-                    )
-                ) as routing
-                on netwerk.source = routing.target -- Is the source of the link reachable? # noqa: E501
+                -- joins with the nodes which are unreachable
+                left join unnest(%(unreachable_nodes)s::bigint[])
+                    as unreachable(node)
+                on netwerk.source = unreachable.node -- Is the source of the link unreachable? # noqa: E501
 
                 -- BLOCK 3; FROM,
                 -- Joins with stremmingen to find all direct unreachable links
@@ -142,6 +420,7 @@ def query_db_road_obstructions(time_from, time_to):
                         and id > 0
                     )
                     and netwerk.cost > 0
+                    {road_filter}
                     and (
                         (
                             strem.start_date <= %(time_to)s
@@ -161,67 +440,128 @@ def query_db_road_obstructions(time_from, time_to):
         ) t2
 
         on t1.linknr = t2.id
-        group by t1.geom, t1.linknr, t1.name, t2.bereikbaar_status_code
+        group by t1.geom, t1.geom4326simply, t1.geom4326overview, t1.linknr,
+            t1.name, t2.bereikbaar_status_code
         order by t1.linknr
     """
+    ).format(road_filter=road_filter)
+
 
+def road_obstructions_query_params(time_from, time_to):
+    """
+    Creates the parameters of road_obstructions_query, including the nodes
+    which can't be reached because of the obstructions
+    :param time_from: string - e.g "2022-05-29 08:00:00"
+    :param time_to: string - e.g "2022-05-29 16:00:00"
+    :return: dict - the query parameters
+    """
     query_params = {
-        "pgr_dijkstra_cost_query": prepare_pgr_dijkstra_cost_query(
-            time_from, time_to
-        ),
         "time_from": time_from,
         "time_to": time_to,
     }
 
-    try:
-        return query_db(db_query, query_params)
+    index = get_obstruction_index()
+    obstructed = index.road_element_ids[
+        list(index.active_obstructions(time_from, time_to))
+    ]
 
-    except Exception:
-        print("Error while retrieving road obstructions")
+    graph = get_graph()
+    query_params["unreachable_nodes"] = graph.obstructed_unreachable_nodes(
+        frozenset(obstructed.tolist()), positive_cost=True
+    ).tolist()
+
+    return query_params
 
 
-def prepare_pgr_dijkstra_cost_query(time_from, time_to):
+def load_obstruction_index():
+    """
+    Loads the start and end dates of the obstructions from the database.
+    Dates are converted like the time window parameters of the road
+    obstructions query, so comparisons give the same results.
+    :return: ObstructionIndex
+    """
+    db_query = """
+        select vma_linknr, start_date::timestamp, end_date::timestamp
+        from bereikbaarheid.bd_stremmingen
     """
-    Helper function for the query_db_road_obstructions function
-    Prepares a database query for use in the pgr_dijkstraCost db function
 
-    This preparation is needed because the pgr_dijkstraCost db function uses
-    psycopg placeholders. When defining this query inline - in the db_query
-    variable of the query_db_road_obstructions function above - the
-    %(time_to)s and %(time_from)s placeholders cause a SQL syntax error
-    (because the date's are single-quoted within a single quoted statement).
-    Therefore this query is prepared first, and returned for use as a
-    query parameter in the query_db_road_obstructions function.
+    rows = query_db(db_query, {})
 
-    :param time_from: string - e.g "2022-05-29 08:00:00"
-    :param time_to: string - e.g "2022-05-29 16:00:00"
-    :return: prepared db query for use in the pgr_dijkstraCost db function
+    return ObstructionIndex(
+        [i[0] for i in rows], [i[1] for i in rows], [i[2] for i in rows]
+    )
+
+
+def get_obstruction_index():
     """
+    Returns the obstruction index, loading it when it is not cached. When
+    loaded, the road obstructions of the coming days are cached in the
+    background if OBSTRUCTIONS_PREWARM_DAYS is set.
+    Must be called within an application context.
+    :return: ObstructionIndex
+    """
+    app = current_app._get_current_object()
 
-    pgr_dijkstra_cost_query = """
-            select total_network.*
-            from (
-                select nw.id, nw.source, nw.target, nw.cost
-                from bereikbaarheid.out_vma_directed nw
-
-                ) total_network
-            where cost > 0
-            and
-            abs(id) not in (
-                select t1.vma_linknr
-                from bereikbaarheid.bd_stremmingen as t1
-                where start_date <= %(time_to)s
-                and end_date >= %(time_from)s
-            )
-        """
+    def compute():
+        with app.app_context():
+            index = load_obstruction_index()
 
-    pgr_dijkstra_cost_query_params = {
-        "time_from": time_from,
-        "time_to": time_to,
-    }
+        if app.config["OBSTRUCTIONS_PREWARM_DAYS"]:
+            # the new index is stored first, as the prewarmed responses
+            # are computed with the cached index
+            obstruction_index_cache.set(None, index)
+
+            threading.Thread(
+                target=prewarm_road_obstructions,
+                args=(app, index, app.config["OBSTRUCTIONS_PREWARM_DAYS"]),
+                daemon=True,
+            ).start()
+
+        return index
+
+    index = obstruction_index_cache.get_or_compute(None, compute)
+
+    if index is None:
+        raise RuntimeError("The obstruction index could not be loaded")
+
+    return index
+
+
+def prewarm_road_obstructions(app, index, days):
+    """
+    Caches the /road-obstructions/ responses of the coming days: of the
+    whole days, which is what is requested by default, and of the
+    intervals between the breakpoints of the obstruction index. Windows
+    with the same active obstructions are computed once. At most half of
+    the cache is filled, so there is room for other requests.
+    :param app: the Flask app
+    :param index: ObstructionIndex - the index the responses are cached
+        for
+    :param days: int - number of days, starting today
+    """
+    today = datetime.combine(datetime.now(tz_amsterdam).date(), time.min)
+    dates = [today + timedelta(days=i) for i in range(days)]
+
+    windows = [(date, datetime.combine(date, time.max)) for date in dates]
+    windows += [
+        (moment, moment)
+        for moment in index.interval_moments(
+            today, today + timedelta(days=days)
+        )
+    ]
+
+    cache_keys = set()
+
+    for time_from, time_to in windows:
+        if len(cache_keys) >= road_obstructions_cache.maxsize // 2:
+            return
+
+        cache_key = road_obstructions_cache_key(
+            time_from, time_to, index=index
+        )
 
-    cursor = get_db().cursor()
+        if cache_key in cache_keys:
+            continue
 
-    return cursor.mogrify(
-        pgr_dijkstra_cost_query, pgr_dijkstra_cost_query_params
-    ).decode("utf-8")
+        cache_keys.add(cache_key)
+        cached_road_obstructions(app, cache_key, time_from, time_to)
@@ -1,120 +1,94 @@
+from datetime import datetime, timezone
+import glob
+import os
+import uuid
+
+from flask import current_app, request
+from marshmallow import Schema, fields, validate
+from psycopg2 import sql
+from webargs.fields import DelimitedList
+from webargs.flaskparser import use_args
+
 from .. import api
-from ...db import query_db
+from ..geojson import (
+    bbox_filter,
+    conditional_response,
+    feature_collection_chunks,
+    feature_collection_response,
+    line_geometry,
+    simplify_tolerance,
+)
+from ..validation import validate_bbox, zoom_levels
+from ...cache import Cache
+from ...db import query_db, query_db_stream
+
+# Serialized responses, keyed by the simplification of the geometry. The
+# value holds the fingerprint of the data it was created from, see
+# cached_load_unload.
+load_unload_cache = Cache(
+    "load_unload",
+    maxsize=4,
+    tables=["bd_venstertijdwegen", "out_vma_undirected"],
+)
+
+# Responses are also stored in CACHE_DIR, so they survive restarts and
+# are shared by the workers
+CACHE_FILE_PREFIX = "load-unload-"
+
+
+class LoadUnloadValidationSchema(Schema):
+    bbox = DelimitedList(
+        fields.Float(), required=False, validate=validate_bbox
+    )
+
+    zoom = fields.Integer(
+        required=False,
+        validate=[
+            validate.Range(min=zoom_levels["min"], max=zoom_levels["max"])
+        ],
+    )
 
 
 @api.get("/road-sections/load-unload/")
-def load_unload_data():
-    result = query_db_load_unload()
+@use_args(LoadUnloadValidationSchema(), location="query")
+def load_unload_data(args):
+    # the load unload data only changes when bd_venstertijdwegen is
+    # reloaded, so complete responses are cached
+    if "bbox" not in args:
+        cached = cached_load_unload(args.get("zoom"))
+
+        if cached is not None:
+            return conditional_response(*cached)
+
+    result = query_db_load_unload(
+        args.get("zoom"),
+        args.get("bbox"),
+        current_app.config["GEOJSON_STREAMING"],
+    )
 
-    # https://datatracker.ietf.org/doc/html/rfc7946#section-3.3
-    return {
-        "type": "FeatureCollection",
-        "features": [i[0] for i in result] if result else [],
-    }
+    return feature_collection_response(result)
 
 
-def query_db_load_unload():
+def query_db_load_unload(zoom=None, bbox=None, stream=False):
     """
     Queries database for road sections with load unload data
+    :param zoom: int - zoom level of the map, for simplifying the geometry
+    :param bbox: list - optional, only road sections intersecting this
+        bounding box (min lon, min lat, max lon, max lat) are returned
+    :param stream: if the results should be fetched in batches
     :return: object - road sections with load unload data
     """
-    db_query = """
+    db_query = sql.SQL(
+        """
         with load_unload as (
             select abs(bd.linknr) as linknr_abs,
             case
-                when bd.linknr > 0
-                    and degrees(
-                        st_azimuth(
-                            st_startpoint(st_linemerge(vma.geom)),
-                            st_endpoint(st_linemerge(vma.geom))
-                        )
-                    ) < 45
-                    then 'noord'
-
-                when bd.linknr > 0
-                    and degrees(
-                        st_azimuth(
-                            st_startpoint(st_linemerge(vma.geom)),
-                            st_endpoint(st_linemerge(vma.geom))
-                        )
-                    ) < 45 + 90
-                    then 'oost'
-
-                when bd.linknr > 0
-                    and degrees(
-                        st_azimuth(
-                            st_startpoint(st_linemerge(vma.geom)),
-                            st_endpoint(st_linemerge(vma.geom))
-                        )
-                    ) < 45 + 180
-                    then 'zuid'
-
-                when bd.linknr > 0
-                    and degrees(
-                        st_azimuth(
-                            st_startpoint(st_linemerge(vma.geom)),
-                            st_endpoint(st_linemerge(vma.geom))
-                        )
-                    ) < 45 + 270
-                    then 'west'
-
-                when bd.linknr > 0
-                    and degrees(
-                        st_azimuth(
-                            st_startpoint(st_linemerge(vma.geom)),
-                            st_endpoint(st_linemerge(vma.geom))
-                        )
-                    ) > 45 + 270
-                    then 'noord'
-
-                when bd.linknr > 0 then 'geen'
-
-                when bd.linknr < 0
-                    and degrees(
-                        st_azimuth(
-                            st_endpoint(st_linemerge(vma.geom)),
-                            st_startpoint(st_linemerge(vma.geom))
-                        )
-                    ) < 45
-                    then 'noord'
-
-                when bd.linknr < 0
-                    and degrees(
-                        st_azimuth(
-                            st_endpoint(st_linemerge(vma.geom)),
-                            st_startpoint(st_linemerge(vma.geom))
-                        )
-                    ) < 45 + 90
-                    then 'oost'
-
-                when bd.linknr < 0
-                    and degrees(
-                        st_azimuth(
-                            st_endpoint(st_linemerge(vma.geom)),
-                            st_startpoint(st_linemerge(vma.geom))
-                        )
-                    ) < 45 + 180
-                    then 'zuid'
-
-                when bd.linknr < 0
-                    and degrees(
-                        st_azimuth(
-                            st_endpoint(st_linemerge(vma.geom)),
-                            st_startpoint(st_linemerge(vma.geom))
-                        )
-                    ) < 45 + 270
-                    then 'west'
-
-                when bd.linknr < 0
-                    and degrees(
-                        st_azimuth(
-                            st_endpoint(st_linemerge(vma.geom)),
-                            st_startpoint(st_linemerge(vma.geom))
-                        )
-                    ) > 45 + 270
-                    then 'noord'
-                else  'geen'
-
+                when azimuth < 45 then 'noord'
+                when azimuth < 45 + 90 then 'oost'
+                when azimuth < 45 + 180 then 'zuid'
+                when azimuth < 45 + 270 then 'west'
+                when azimuth > 45 + 270 then 'noord'
+                else 'geen'
             end as richting,
 
             bd.linknr,
@@ -125,6 +99,8 @@ def query_db_load_unload():
             bd.eind_tijd,
             vma.car_network,
             vma.geom,
+            vma.geom4326simply,
+            vma.geom4326overview,
             vma.name
 
             from bereikbaarheid.bd_venstertijdwegen bd
@@ -132,11 +108,27 @@ def query_db_load_unload():
             left join bereikbaarheid.out_vma_undirected vma
                 on abs(bd.linknr) = vma.linknr
 
+            -- the direction of the road section, from the start to the
+            -- end of the geometry for positive linknr
+            left join lateral (
+                select degrees(
+                    case
+                        when bd.linknr > 0 then st_azimuth(
+                            st_startpoint(line.geom), st_endpoint(line.geom)
+                        )
+                        when bd.linknr < 0 then st_azimuth(
+                            st_endpoint(line.geom), st_startpoint(line.geom)
+                        )
+                    end
+                ) as azimuth
+                from (select st_linemerge(vma.geom) as geom) line
+            ) direction on true
+
             order by bd.linknr
         )
 
         select json_build_object(
-            'geometry', ST_Transform(load_unload.geom, 4326)::json,
+            'geometry', {geometry}::json,
             'properties', json_build_object(
                 'id', load_unload.linknr_abs,
                 'street_name', load_unload.name,
@@ -154,12 +146,170 @@ def query_db_load_unload():
         from load_unload
 
         where load_unload.geom is not null
-        group by load_unload.geom, load_unload.linknr_abs, load_unload.name
+        {bbox_filter}
+        group by load_unload.geom, load_unload.geom4326simply,
+            load_unload.geom4326overview, load_unload.linknr_abs,
+            load_unload.name
         order by load_unload.linknr_abs
     """
+    ).format(
+        geometry=line_geometry(
+            zoom,
+            "load_unload.geom",
+            simplified="load_unload.geom4326simply",
+            overview="load_unload.geom4326overview",
+        ),
+        bbox_filter=bbox_filter(bbox, "load_unload.geom", 28992),
+    )
 
     try:
-        return query_db(db_query, {})
+        if stream:
+            return query_db_stream(db_query, {}, raw_json=True)
+
+        return query_db(db_query, {}, raw_json=True)
 
     except Exception:
         print("Error while retrieving road sections with load-unload data")
+
+
+def cached_load_unload(zoom=None):
+    """
+    Returns the load unload response from the cache. On a cache miss the
+    fingerprint of the data is queried first: requests with a matching
+    ETag need no further work, and a response stored in CACHE_DIR with
+    the same fingerprint is used if there is one.
+    :param zoom: int - zoom level of the map, for simplifying the geometry
+    :return: tuple - the body, ETag and last modified time (None if
+        the response is not stored in CACHE_DIR), or None on error
+    """
+    tolerance = simplify_tolerance(zoom)
+    cached = load_unload_cache.get(tolerance)
+
+    if cached is not None:
+        return cached
+
+    try:
+        fingerprint = query_db_load_unload_fingerprint()
+    except Exception:
+        print("Error while retrieving load-unload fingerprint")
+        return None
+
+    etag = f"{fingerprint}-{tolerance or 0}"
+
+    # the client has this version already, the body is not needed
+    if request.if_none_match.contains(etag):
+        return None, etag, None
+
+    directory = current_app.config["CACHE_DIR"]
+    path = (
+        os.path.join(directory, f"{CACHE_FILE_PREFIX}{etag}.json")
+        if directory
+        else None
+    )
+
+    body = None
+
+    if path is not None and os.path.exists(path):
+        try:
+            with open(path) as f:
+                body = f.read()
+            modified = os.path.getmtime(path)
+        except OSError as error:
+            print("Error while reading load-unload data: ", error)
+            body = None
+
+    if body is None:
+        result = query_db_load_unload(zoom)
+
+        if result is None:
+            return None
+
+        body = "".join(feature_collection_chunks(result))
+        modified = write_load_unload_file(path, body, fingerprint)
+
+    # without a stored file there is no modification time that all
+    # workers agree on, the ETag is the only validator then
+    cached = (
+        body,
+        etag,
+        datetime.fromtimestamp(int(modified), tz=timezone.utc)
+        if modified is not None
+        else None,
+    )
+    load_unload_cache.set(tolerance, cached)
+
+    return cached
+
+
+def write_load_unload_file(path, body, fingerprint):
+    """
+    Stores a response in CACHE_DIR, responses of other fingerprints are
+    removed. The first stored file of a fingerprint is kept, so its
+    modification time is the same for all workers.
+    :param path: string - path of the file, or None if there is no
+        CACHE_DIR
+    :param body: string - the response
+    :param fingerprint: string - fingerprint of the data
+    :return: float - the modification time, or None if the response
+        could not be stored
+    """
+    if path is None:
+        return None
+
+    # each worker writes its own temporary file, which is linked into
+    # place only if no other worker stored the response already
+    temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+
+    try:
+        with open(temporary, "w") as f:
+            f.write(body)
+
+        try:
+            os.link(temporary, path)
+        except FileExistsError:
+            pass
+
+        os.remove(temporary)
+
+        directory = os.path.dirname(path)
+        for old in glob.glob(
+            os.path.join(directory, f"{CACHE_FILE_PREFIX}*.json")
+        ):
+            if not os.path.basename(old).startswith(
+                f"{CACHE_FILE_PREFIX}{fingerprint}-"
+            ):
+                os.remove(old)
+
+        return os.path.getmtime(path)
+
+    except OSError as error:
+        print("Error while storing load-unload data: ", error)
+
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+def query_db_load_unload_fingerprint():
+    """
+    Queries a fingerprint of the data of the load unload response, which
+    is much cheaper than the response itself
+    :return: string - md5 hash of the data
+    """
+    db_query = """
+        select md5(coalesce(string_agg(
+            concat_ws(
+                '|',
+                bd::text,
+                vma.name,
+                vma.car_network,
+                md5(st_asbinary(vma.geom))
+            ),
+            ',' order by bd.linknr, bd::text
+        ), ''))
+        from bereikbaarheid.bd_venstertijdwegen bd
+
+        left join bereikbaarheid.out_vma_undirected vma
+            on abs(bd.linknr) = vma.linknr
+    """
+
+    return query_db(db_query, {}, fetch_one=True)[0]
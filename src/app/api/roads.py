@@ -1,13 +1,34 @@
-from flask import jsonify
+from collections import namedtuple
+from flask import current_app
 from marshmallow import Schema, fields, validate, validates
+from psycopg2 import sql
+from webargs.fields import DelimitedList
 from webargs.flaskparser import use_args
 from . import api
-from .validation import vehicle, allowed_vehicle_types
+from .validation import (
+    vehicle,
+    allowed_vehicle_types,
+    validate_bbox,
+    zoom_levels,
+)
 from . import vehicleTypes
-from ..db import query_db
+from .geojson import (
+    bbox_filter,
+    feature_collection_chunks,
+    feature_collection_response,
+    line_geometry,
+    simplify_tolerance,
+)
+from ..cache import Cache
+from ..db import query_db, query_db_stream
+from ..routing import get_graph
 
 
 class ProhibitoryRoadsValidationSchema(Schema):
+    bbox = DelimitedList(
+        fields.Float(), required=False, validate=validate_bbox
+    )
+
     permitLowEmissionZone = fields.Boolean(required=True)
     permitZzv = fields.Boolean(required=True)
 
@@ -78,23 +99,139 @@ class ProhibitoryRoadsValidationSchema(Schema):
         ],
     )
 
+    zoom = fields.Integer(
+        required=False,
+        validate=[
+            validate.Range(min=zoom_levels["min"], max=zoom_levels["max"])
+        ],
+    )
+
+
+# Cache key of the prohibitory roads of a vehicle, see
+# prohibitory_roads_cache_key
+ProhibitoryRoadsKey = namedtuple(
+    "ProhibitoryRoadsKey",
+    [
+        "status_class",
+        "routing_class",
+        "permit_low_emission_zone",
+        "permit_zzv",
+    ],
+)
+
+# Serialized /roads/prohibitory responses, see prohibitory_roads_cache_key
+prohibitory_roads_cache = Cache(
+    "prohibitory_roads",
+    maxsize=32,
+    tables=["out_vma_directed"],
+    stale=True,
+    shared=True,
+)
+
 
 @api.route("/roads/prohibitory")
 @use_args(ProhibitoryRoadsValidationSchema(), location="query")
 def roads_prohibitory(args):
-    return jsonify(
-        query_db_prohibitory_roads(
-            args["vehicleType"],
-            args["vehicleLength"],
-            args["vehicleWidth"],
-            args["vehicleHasTrailer"],
-            args["vehicleHeight"],
-            args["vehicleAxleWeight"],
-            args["vehicleTotalWeight"],
-            args["vehicleMaxAllowedWeight"],
-            args["permitLowEmissionZone"],
-            args["permitZzv"],
+    # responses for a viewport are not cached, these rarely repeat
+    try:
+        cache_key = (
+            None
+            if "bbox" in args
+            else (
+                prohibitory_roads_cache_key(args),
+                simplify_tolerance(args.get("zoom")),
+            )
         )
+    except Exception:
+        cache_key = None
+
+    if cache_key is None:
+        return feature_collection_response(
+            query_db_prohibitory_roads(
+                *prohibitory_roads_args(args),
+                args.get("zoom"),
+                args.get("bbox"),
+                current_app.config["GEOJSON_STREAMING"],
+            )
+        )
+
+    # the response is computed once, also for concurrent requests, and an
+    # expired response is served while it is refreshed in the background
+    app = current_app._get_current_object()
+    zoom = args.get("zoom")
+
+    # the rows are fetched in batches with GEOJSON_STREAMING, so only the
+    # serialized response is held in memory as a whole
+    def compute():
+        with app.app_context():
+            result = query_db_prohibitory_roads(
+                *prohibitory_roads_args(args),
+                zoom,
+                stream=app.config["GEOJSON_STREAMING"],
+            )
+
+            if result is None:
+                return None
+
+            return "".join(feature_collection_chunks(result))
+
+    body = prohibitory_roads_cache.get_or_compute(cache_key, compute)
+
+    # errors are not cached
+    if body is None:
+        return feature_collection_response(None)
+
+    return current_app.response_class(body, mimetype="application/json")
+
+
+def prohibitory_roads_args(args):
+    """
+    :param args: dict - ProhibitoryRoadsValidationSchema arguments
+    :return: list - the vehicle and permit arguments of
+        query_db_prohibitory_roads
+    """
+    return [
+        args["vehicleType"],
+        args["vehicleLength"],
+        args["vehicleWidth"],
+        args["vehicleHasTrailer"],
+        args["vehicleHeight"],
+        args["vehicleAxleWeight"],
+        args["vehicleTotalWeight"],
+        args["vehicleMaxAllowedWeight"],
+        args["permitLowEmissionZone"],
+        args["permitZzv"],
+    ]
+
+
+def prohibitory_roads_cache_key(args):
+    """
+    The prohibitory roads depend on the traffic sign maximum values which
+    are smaller than the vehicle's dimensions and weights (the status
+    codes), and on the maximum values it exceeds with the margins used for
+    routing (the unreachable nodes). Vehicles for which both are the same
+    get the same prohibitory roads. So the cache key consists of these two
+    vehicle classes and the permits of the vehicle.
+    :param args: dict - ProhibitoryRoadsValidationSchema arguments
+    :return: ProhibitoryRoadsKey - the cache key
+    """
+    vehicle = vehicleTypes.routing_vehicle(
+        args["vehicleType"],
+        args["vehicleLength"],
+        args["vehicleWidth"],
+        args["vehicleHasTrailer"],
+        args["vehicleHeight"],
+        args["vehicleAxleWeight"],
+        args["vehicleTotalWeight"],
+        args["vehicleMaxAllowedWeight"],
+    )
+    graph = get_graph()
+
+    return ProhibitoryRoadsKey(
+        graph.vehicle_class(vehicle, strict=True),
+        graph.vehicle_class(vehicle, margins=True),
+        args["permitLowEmissionZone"],
+        args["permitZzv"],
     )
 
 
@@ -109,6 +246,9 @@ def query_db_prohibitory_roads(
     vehicle_max_allowed_weight,
     permit_low_emission_zone,
     permit_zzv,
+    zoom=None,
+    bbox=None,
+    stream=False,
 ):
     """
     Fetches prohibitory roads from database
@@ -124,154 +264,201 @@ def query_db_prohibitory_roads(
         if a low emission permit is needed based on vehicle properties
     :param permit_zzv: 'true' or 'false'
         if a heavy goods vehicle permit is needed based on vehicle properties
+    :param zoom: int - zoom level of the map, for simplifying the geometry
+    :param bbox: list - optional, only roads intersecting this bounding box
+        (min lon, min lat, max lon, max lat) are returned
+    :param stream: if the results should be fetched in batches
     :return: object - prohibitory roads based on vehicle properties
     """
-
-    # default response
-    # https://datatracker.ietf.org/doc/html/rfc7946#section-3.3
-    response = {"type": "FeatureCollection", "features": []}
-
-    db_query = """
+    db_query = sql.SQL(
+        """
         select json_build_object(
             'type','Feature',
             'properties',json_build_object(
             'bereikbaar_status_code', bereikbaar_status_code,
             'id',id),
-            'geometry', geom::json
+            'geometry', ST_AsGeoJSON(geom)::json
         )
-        from (
-            select v.id,
-            case
-                when v.bereikbaar_status_code = 333 then 333
-                when v.milieuzone = true and v.zone_7_5 = true
-                    and v.bereikbaar_status_code = 222
-                    and %(permit_zone_milieu)s = true
-                    and %(permit_zone_7_5)s = true
-                    then 11111
-                when v.milieuzone = true and v.zone_7_5 = true
-                    and v.bereikbaar_status_code <> 222
-                    and %(permit_zone_milieu)s = true
-                    and %(permit_zone_7_5)s = true
-                    then 11110
-                when v.milieuzone = true and v.zone_7_5 = false
-                    and v.bereikbaar_status_code <> 222
-                    and %(permit_zone_milieu)s = true
-                    then 11100
-                when v.milieuzone = true and v.zone_7_5 = false
-                    and v.bereikbaar_status_code = 222
-                    and %(permit_zone_milieu)s = true
-                    or v.milieuzone = true and v.zone_7_5 = true
-                    and v.bereikbaar_status_code = 222
-                    and %(permit_zone_milieu)s = true
-                    and %(permit_zone_7_5)s = false
-                    then 11101
-                when v.milieuzone = false and v.zone_7_5 = true
-                    and v.bereikbaar_status_code = 222
-                    and %(permit_zone_7_5)s = true
-                    or v.milieuzone = true and v.zone_7_5 = true
-                    and v.bereikbaar_status_code = 222
-                    and %(permit_zone_milieu)s = false
-                    and %(permit_zone_7_5)s = true
-                    then 11011
-                when v.milieuzone = false and v.zone_7_5 = true
-                    and v.bereikbaar_status_code <> 222
-                    and %(permit_zone_7_5)s = true
-                    then 11010
-                when v.milieuzone = false and v.zone_7_5 = false
-                    and v.bereikbaar_status_code = 222
-                    or v.milieuzone = true and v.zone_7_5 = true
+        from ({prohibitory_roads}) m """
+    ).format(
+        prohibitory_roads=prohibitory_roads_query(
+            road_filter=bbox_filter(bbox, "g.geom4326"),
+            geometry=line_geometry(
+                zoom,
+                "g.geom",
+                full="g.geom4326",
+                simplified="g.geom4326simply",
+                overview="g.geom4326overview",
+            ),
+        )
+    )
+
+    try:
+        query_params = prohibitory_roads_query_params(
+            vehicle_type,
+            vehicle_length,
+            vehicle_width,
+            vehicle_has_trailer,
+            vehicle_height,
+            vehicle_axle_weight,
+            vehicle_total_weight,
+            vehicle_max_allowed_weight,
+            permit_low_emission_zone,
+            permit_zzv,
+        )
+
+        if stream:
+            return query_db_stream(db_query, query_params, raw_json=True)
+
+        return query_db(db_query, query_params, raw_json=True)
+
+    except Exception:
+        print("Error while retrieving prohibitory roads")
+
+
+def prohibitory_roads_query(
+    road_filter=sql.SQL(""), geometry=sql.SQL("g.geom4326")
+):
+    """
+    The road elements which are prohibited for a vehicle, with their
+    bereikbaar_status_code and geometry (geom, EPSG:4326). Used for both
+    the GeoJSON and the vector tile output, with the parameters created
+    by prohibitory_roads_query_params.
+    :param road_filter: psycopg2.sql.Composable - optional extra condition
+        on the road elements (g), starting with 'and'
+    :param geometry: psycopg2.sql.Composable - optional expression for
+        the geometry of the road elements (g), see geojson.line_geometry
+    :return: psycopg2.sql.Composed - the query
+    """
+    return sql.SQL(
+        """
+        select v.id,
+        case
+            when v.bereikbaar_status_code = 333 then 333
+            when v.milieuzone = true and v.zone_7_5 = true
+                and v.bereikbaar_status_code = 222
+                and %(permit_zone_milieu)s = true
+                and %(permit_zone_7_5)s = true
+                then 11111
+            when v.milieuzone = true and v.zone_7_5 = true
+                and v.bereikbaar_status_code <> 222
+                and %(permit_zone_milieu)s = true
+                and %(permit_zone_7_5)s = true
+                then 11110
+            when v.milieuzone = true and v.zone_7_5 = false
+                and v.bereikbaar_status_code <> 222
+                and %(permit_zone_milieu)s = true
+                then 11100
+            when v.milieuzone = true and v.zone_7_5 = false
+                and v.bereikbaar_status_code = 222
+                and %(permit_zone_milieu)s = true
+                or v.milieuzone = true and v.zone_7_5 = true
+                and v.bereikbaar_status_code = 222
+                and %(permit_zone_milieu)s = true
+                and %(permit_zone_7_5)s = false
+                then 11101
+            when v.milieuzone = false and v.zone_7_5 = true
+                and v.bereikbaar_status_code = 222
+                and %(permit_zone_7_5)s = true
+                or v.milieuzone = true and v.zone_7_5 = true
+                and v.bereikbaar_status_code = 222
+                and %(permit_zone_milieu)s = false
+                and %(permit_zone_7_5)s = true
+                then 11011
+            when v.milieuzone = false and v.zone_7_5 = true
+                and v.bereikbaar_status_code <> 222
+                and %(permit_zone_7_5)s = true
+                then 11010
+            when v.milieuzone = false and v.zone_7_5 = false
+                and v.bereikbaar_status_code = 222
+                or v.milieuzone = true and v.zone_7_5 = true
+                and v.bereikbaar_status_code = 222
+                and %(permit_zone_milieu)s = false
+                and %(permit_zone_7_5)s = false
+                or (
+                    v.milieuzone = true and v.zone_7_5 = false
                     and v.bereikbaar_status_code = 222
                     and %(permit_zone_milieu)s = false
-                    and %(permit_zone_7_5)s = false
-                    or (
-                        v.milieuzone = true and v.zone_7_5 = false
-                        and v.bereikbaar_status_code = 222
-                        and %(permit_zone_milieu)s = false
-                    )
-                    then 11001
-                else 999
-            end as bereikbaar_status_code,
-            v.geom from (
-                select
-                    abs(n.id) as id,
-                    max(
-                        case
-                            when n.cost is NULL then 333
-                            when routing.agg_cost is null then 222
-                            when n.c07 is true and %(bedrijfsauto)s is true
-                                and %(max_massa)s > 3500
-                                or n.c07a is true and %(bus)s is true
-                                or n.c10 is true and %(aanhanger)s is true
-                                or n.c01 is true
-                                or n.c17 < %(lengte)s
-                                or n.c18 < %(breedte)s
-                                or n.c19 < %(hoogte)s
-                                or n.c20 < %(aslast)s
-                                or n.c21 < %(gewicht)s
-                                then 222
-                            else 999
-                        end
-                    ) as bereikbaar_status_code,
-                    ST_AsGeoJSON(g.geom4326) as geom,
-                    g.zone_7_5,
-                    g.milieuzone,
-                    g.binnen_amsterdam
-                from bereikbaarheid.out_vma_directed n
-                left join (
-                    SELECT start_vid as source,
-                    end_vid as target,
-                    agg_cost FROM pgr_dijkstraCost('
-                        select id, source, target, cost
-                        from bereikbaarheid.out_vma_directed
-                        where cost > 0
-                        and (
-                            (( -.01 + %(lengte)s ) < c17 or c17 is null)
-                            and (( -.01 + %(breedte)s ) < c18 or c18 is null)
-                            and (( -.01 +%(hoogte)s ) < c19 or c19 is null)
-                            and (( -1 + %(aslast)s ) < c20 or c20 is null)
-                            and (( -1 + %(gewicht)s ) < c21 or c21 is null)
-                            and (c01 is false)
-                            and (
-                                c07 is false
-                                or (c07 is true and %(bedrijfsauto)s is false)
-                                or (
-                                    c07 is true
-                                    and %(bedrijfsauto)s is true
-                                    and %(max_massa)s <= 3500
-                                )
-                            )
-                            and (
-                                c07a is false
-                                or (c07a is true and %(bus)s is false)
-                            )
-                            and (
-                                c10 is false
-                                or (c10 is true and %(aanhanger)s is false)
-                            )
-                        )',
-                        902205,
-                        array(
-                            select node
-                            from bereikbaarheid.out_vma_node
-                        )
-                    )
-                ) as routing on n.source = routing.target
-
-                left join bereikbaarheid.out_vma_directed g
-                    on abs(n.id) = g.id
-                    where abs(n.id) in (
-                        select id from bereikbaarheid.out_vma_directed
-                        where id > 0
-                    )
-                    and n.cost > 0
-
-            group by abs(n.id), g.geom4326, g.zone_7_5,
-            g.milieuzone,g.binnen_amsterdam
-            order by abs(n.id)
-            ) v
-            where v.bereikbaar_status_code <> 999
-            and v.binnen_amsterdam is true
-        ) m """
+                )
+                then 11001
+            else 999
+        end as bereikbaar_status_code,
+        v.geom from (
+            select
+                abs(n.id) as id,
+                max(
+                    case
+                        when n.cost is NULL then 333
+                        when unreachable.node is not null then 222
+                        when n.c07 is true and %(bedrijfsauto)s is true
+                            and %(max_massa)s > 3500
+                            or n.c07a is true and %(bus)s is true
+                            or n.c10 is true and %(aanhanger)s is true
+                            or n.c01 is true
+                            or n.c17 < %(lengte)s
+                            or n.c18 < %(breedte)s
+                            or n.c19 < %(hoogte)s
+                            or n.c20 < %(aslast)s
+                            or n.c21 < %(gewicht)s
+                            then 222
+                        else 999
+                    end
+                ) as bereikbaar_status_code,
+                {geometry} as geom,
+                g.zone_7_5,
+                g.milieuzone,
+                g.binnen_amsterdam
+            from bereikbaarheid.out_vma_directed n
+            left join unnest(%(unreachable_nodes)s::bigint[])
+                as unreachable(node) on n.source = unreachable.node
+
+            left join bereikbaarheid.out_vma_directed g
+                on abs(n.id) = g.id
+                where abs(n.id) in (
+                    select id from bereikbaarheid.out_vma_directed
+                    where id > 0
+                )
+                and n.cost > 0
+                {road_filter}
+
+        group by abs(n.id), {geometry}, g.zone_7_5,
+        g.milieuzone,g.binnen_amsterdam
+        order by abs(n.id)
+        ) v
+        where v.bereikbaar_status_code <> 999
+        and v.binnen_amsterdam is true
+    """
+    ).format(road_filter=road_filter, geometry=geometry)
+
+
+def prohibitory_roads_query_params(
+    vehicle_type,
+    vehicle_length,
+    vehicle_width,
+    vehicle_has_trailer,
+    vehicle_height,
+    vehicle_axle_weight,
+    vehicle_total_weight,
+    vehicle_max_allowed_weight,
+    permit_low_emission_zone,
+    permit_zzv,
+):
+    """
+    Creates the parameters of prohibitory_roads_query, including the nodes
+    which the vehicle can't reach. See query_db_prohibitory_roads for the
+    description of the parameters.
+    :return: dict - the query parameters
+    """
+    vehicle = vehicleTypes.routing_vehicle(
+        vehicle_type,
+        vehicle_length,
+        vehicle_width,
+        vehicle_has_trailer,
+        vehicle_height,
+        vehicle_axle_weight,
+        vehicle_total_weight,
+        vehicle_max_allowed_weight,
+    )
 
     query_params = {
         "bus": vehicleTypes.vehicle_is_bus(vehicle_type),
@@ -287,13 +474,9 @@ def query_db_prohibitory_roads(
         "permit_zone_7_5": permit_zzv,
     }
 
-    try:
-        result = query_db(db_query, query_params)
-
-        if result:
-            response["features"] = [i[0] for i in result]
-
-    except Exception:
-        print("Error while retrieving prohibitory roads")
+    graph = get_graph()
+    query_params["unreachable_nodes"] = graph.class_unreachable_nodes(
+        graph.vehicle_class(vehicle, margins=True), positive_cost=True
+    ).tolist()
 
-    return response
+    return query_params
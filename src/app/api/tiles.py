@@ -0,0 +1,279 @@
+from datetime import datetime
+from flask import abort, current_app
+from psycopg2 import sql
+from webargs.flaskparser import use_args
+from . import api
+from .road_obstructions import (
+    RoadObstructionsValidationSchema,
+    road_obstructions_cache_key,
+    road_obstructions_query,
+    road_obstructions_query_params,
+)
+from .roads import (
+    ProhibitoryRoadsValidationSchema,
+    prohibitory_roads_args,
+    prohibitory_roads_cache_key,
+    prohibitory_roads_query,
+    prohibitory_roads_query_params,
+)
+from .validation import zoom_levels
+from ..cache import Cache
+from ..db import query_db
+
+#
+# Mapbox Vector Tiles of the prohibitory roads and road obstructions
+# https://github.com/mapbox/vector-tile-spec/tree/master/2.1
+#
+
+MVT_MIMETYPE = "application/vnd.mapbox-vector-tile"
+
+# Size of a tile in tile coordinates, and the buffer around the tile
+# for features crossing the tile boundary
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+
+# Circumference of the earth in Web Mercator (EPSG:3857) meters
+WEB_MERCATOR_SIZE = 40075016.68
+
+# Serialized tiles, keyed by layer, z, x, y and the layer parameters
+tiles_cache = Cache(
+    "tiles",
+    maxsize=2048,
+    tables=["bd_stremmingen", "out_vma_directed", "out_vma_undirected"],
+    shared=True,
+)
+
+
+@api.get("/tiles/prohibitory-roads/<int:z>/<int:x>/<int:y>.pbf")
+@use_args(
+    ProhibitoryRoadsValidationSchema(exclude=["bbox", "zoom"]),
+    location="query",
+)
+def prohibitory_roads_tile(args, z, x, y):
+    validate_tile(z, x, y)
+
+    # tiles of the same vehicle class have the same features, see
+    # roads.prohibitory_roads_cache_key
+    try:
+        cache_key = (
+            "prohibitory-roads",
+            z,
+            x,
+            y,
+            prohibitory_roads_cache_key(args),
+        )
+        tile = tiles_cache.get(cache_key)
+    except Exception:
+        cache_key, tile = None, None
+
+    if tile is None:
+        tile = query_db_prohibitory_roads_tile(z, x, y, args)
+
+        if tile is None:
+            return tile_error()
+
+        if cache_key is not None:
+            tiles_cache.set(cache_key, tile)
+
+    return tile_response(tile)
+
+
+@api.get("/tiles/road-obstructions/<int:z>/<int:x>/<int:y>.pbf")
+@use_args(
+    RoadObstructionsValidationSchema(exclude=["bbox", "zoom"]),
+    location="query",
+)
+def road_obstructions_tile(args, z, x, y):
+    validate_tile(z, x, y)
+
+    time_from = datetime.combine(args["date"], args["timeFrom"])
+    time_to = datetime.combine(args["date"], args["timeTo"])
+
+    try:
+        cache_key = (
+            "road-obstructions",
+            z,
+            x,
+            y,
+            road_obstructions_cache_key(time_from, time_to),
+        )
+        tile = tiles_cache.get(cache_key)
+    except Exception:
+        cache_key, tile = None, None
+
+    if tile is None:
+        tile = query_db_road_obstructions_tile(z, x, y, time_from, time_to)
+
+        if tile is None:
+            return tile_error()
+
+        if cache_key is not None:
+            tiles_cache.set(cache_key, tile)
+
+    return tile_response(tile)
+
+
+def validate_tile(z, x, y):
+    """
+    Aborts the request with a 404 if the tile does not exist
+    :param z: int - zoom level
+    :param x: int - column of the tile
+    :param y: int - row of the tile
+    """
+    if z > zoom_levels["max"] or x >= 2**z or y >= 2**z:
+        abort(404)
+
+
+def tile_response(tile):
+    """
+    :param tile: bytes - the vector tile
+    :return: Flask response
+    """
+    response = current_app.response_class(tile, mimetype=MVT_MIMETYPE)
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config["CACHE_TTL"]
+
+    return response
+
+
+def tile_error():
+    return current_app.response_class(
+        "Error while retrieving tile", status=500, mimetype="text/plain"
+    )
+
+
+def tile_query(features, layer, properties, geom_column, srid):
+    """
+    Creates a query which encodes features as a vector tile. The features
+    are clipped to the tile and simplified to the resolution of the zoom
+    level.
+    :param features: function - creates the features query, given an
+        extra condition on the road elements (g)
+    :param layer: string - name of the layer in the tile
+    :param properties: list of strings - feature columns to include in
+        the tile
+    :param geom_column: string - geometry column of the road elements (g)
+    :param srid: int - spatial reference of geom_column and of the
+        geometry of the features
+    :return: psycopg2.sql.Composed - the query
+    """
+    road_filter = sql.SQL(
+        """
+        and g.{geom} && ST_Transform(
+            ST_TileEnvelope(
+                %(z)s, %(x)s, %(y)s, margin => %(margin)s
+            ),
+            {srid}
+        )"""
+    ).format(
+        geom=sql.Identifier(geom_column),
+        srid=sql.Literal(srid),
+    )
+
+    return sql.SQL(
+        """
+        select coalesce(
+            ST_AsMVT(tile.*, {layer}, %(extent)s, 'geom'), ''::bytea
+        )
+        from (
+            select {properties},
+                ST_AsMVTGeom(
+                    ST_Simplify(
+                        ST_Transform(features.geom, 3857), %(tolerance)s
+                    ),
+                    ST_TileEnvelope(%(z)s, %(x)s, %(y)s),
+                    %(extent)s,
+                    %(buffer)s
+                ) as geom
+            from ({features}) features
+        ) tile
+        where tile.geom is not null
+    """
+    ).format(
+        layer=sql.Literal(layer),
+        properties=sql.SQL(", ").join(sql.SQL(i) for i in properties),
+        features=features(road_filter),
+    )
+
+
+def tile_query_params(z, x, y):
+    """
+    :param z: int - zoom level
+    :param x: int - column of the tile
+    :param y: int - row of the tile
+    :return: dict - the parameters used by tile_query
+    """
+    return {
+        "z": z,
+        "x": x,
+        "y": y,
+        "extent": TILE_EXTENT,
+        "buffer": TILE_BUFFER,
+        "margin": TILE_BUFFER / TILE_EXTENT,
+        # the size of a pixel of the tile in meters
+        "tolerance": WEB_MERCATOR_SIZE / 2**z / TILE_EXTENT,
+    }
+
+
+def query_db_prohibitory_roads_tile(z, x, y, args):
+    """
+    Fetches a vector tile of the prohibitory roads
+    :param z: int - zoom level
+    :param x: int - column of the tile
+    :param y: int - row of the tile
+    :param args: dict - ProhibitoryRoadsValidationSchema arguments
+    :return: bytes - the vector tile, or None on error
+    """
+    db_query = tile_query(
+        prohibitory_roads_query,
+        "prohibitory-roads",
+        ["id", "bereikbaar_status_code"],
+        "geom4326",
+        4326,
+    )
+
+    try:
+        query_params = prohibitory_roads_query_params(
+            *prohibitory_roads_args(args)
+        )
+        query_params.update(tile_query_params(z, x, y))
+
+        return bytes(query_db(db_query, query_params, fetch_one=True)[0])
+
+    except Exception:
+        print("Error while retrieving prohibitory roads tile")
+
+
+def query_db_road_obstructions_tile(z, x, y, time_from, time_to):
+    """
+    Fetches a vector tile of the road obstructions. The obstructions of
+    a road element are encoded as a JSON string, because vector tiles
+    don't support nested properties.
+    :param z: int - zoom level
+    :param x: int - column of the tile
+    :param y: int - row of the tile
+    :param time_from: string - e.g "2022-05-29 08:00:00"
+    :param time_to: string - e.g "2022-05-29 16:00:00"
+    :return: bytes - the vector tile, or None on error
+    """
+    db_query = tile_query(
+        road_obstructions_query,
+        "road-obstructions",
+        [
+            "id as road_element_id",
+            "name as road_element_street_name",
+            "bereikbaar_status_code as road_element_accessibility_code",
+            "obstructions::text as obstructions",
+        ],
+        "geom",
+        28992,
+    )
+
+    try:
+        query_params = road_obstructions_query_params(time_from, time_to)
+        query_params.update(tile_query_params(z, x, y))
+
+        return bytes(query_db(db_query, query_params, fetch_one=True)[0])
+
+    except Exception:
+        print("Error while retrieving road obstructions tile")
@@ -1,13 +1,19 @@
-from flask import jsonify
 from marshmallow import Schema, fields, validate, validates
+from psycopg2 import sql
+from webargs.fields import DelimitedList
 from webargs.flaskparser import use_args
 from . import api
-from .validation import vehicle, allowed_vehicle_types
+from .validation import vehicle, allowed_vehicle_types, validate_bbox
 from . import vehicleTypes
+from .geojson import bbox_filter, feature_collection_response
 from ..db import query_db
 
 
 class TrafficSignsValidationSchema(Schema):
+    bbox = DelimitedList(
+        fields.Float(), required=False, validate=validate_bbox
+    )
+
     trafficSignCategories = fields.List(
         fields.String(
             required=True,
@@ -94,7 +100,7 @@ class TrafficSignsValidationSchema(Schema):
 @api.route("/traffic-signs")
 @use_args(TrafficSignsValidationSchema(), location="query")
 def traffic_signs(args):
-    return jsonify(
+    return feature_collection_response(
         query_db_traffic_signs(
             args["trafficSignCategories"],
             args["vehicleAxleWeight"],
@@ -105,6 +111,7 @@ def traffic_signs(args):
             args["vehicleTotalWeight"],
             args["vehicleType"],
             args["vehicleWidth"],
+            args.get("bbox"),
         )
     )
 
@@ -119,6 +126,7 @@ def query_db_traffic_signs(
     vehicle_total_weight,
     vehicle_type,
     vehicle_width,
+    bbox=None,
 ):
     """
     Fetches traffic signs from database
@@ -132,13 +140,10 @@ def query_db_traffic_signs(
     :param vehicle_axle_weight: int - axle weight of the vehicle
     :param vehicle_total_weight: int - total weight of the vehicle
     :param vehicle_max_allowed_weight: int - max allowed weight of the vehicle
+    :param bbox: list - optional, only traffic signs within this bounding
+        box (min lon, min lat, max lon, max lat) are returned
     :return: object - traffic signs based on vehicle properties and expert mode
     """
-
-    # default response
-    # https://datatracker.ietf.org/doc/html/rfc7946#section-3.3
-    response = {"type": "FeatureCollection", "features": []}
-
     # Map traffic sign category URL parameter to values used in database
     # allows us to change category names without having to change the API
     categories_mapping = {
@@ -150,7 +155,8 @@ def query_db_traffic_signs(
         categories_mapping[cat] for cat in traffic_sign_categories
     ]
 
-    db_query = """
+    db_query = sql.SQL(
+        """
         select json_build_object(
             'type','Feature',
             'properties', json_build_object(
@@ -186,6 +192,7 @@ def query_db_traffic_signs(
             left join bereikbaarheid.out_vma_directed x
             on m.link_gevalideerd = x.id
             where m.link_gevalideerd <> 0
+            {bbox_filter}
             and LOWER(m.geldigheid) in %(traffic_sign_categories)s
             and (
                 m.rvv_modelnummer = 'C01'
@@ -216,6 +223,11 @@ def query_db_traffic_signs(
             )
         ) v
     """
+    ).format(
+        bbox_filter=bbox_filter(
+            bbox, "ST_SetSRID(ST_MakePoint(m.rd_x, m.rd_y), 28992)", 28992
+        )
+    )
 
     query_params = {
         "bus": vehicleTypes.vehicle_is_bus(vehicle_type),
@@ -231,12 +243,7 @@ def query_db_traffic_signs(
     }
 
     try:
-        result = query_db(db_query, query_params)
-
-        if result:
-            response["features"] = [i[0] for i in result]
+        return query_db(db_query, query_params, raw_json=True)
 
     except Exception:
         print("Error while retrieving traffic signs")
-
-    return response
@@ -8,6 +8,9 @@ bbox_adam = {
 
 days_of_the_week_abbreviated = ["ma", "di", "wo", "do", "vr", "za", "zo"]
 
+# Zoom levels of web maps, e.g. used for simplifying geometries
+zoom_levels = {"min": 0, "max": 22}
+
 # The vehicle parameters should be in sync with validation requirements
 # for client-side forms (defined in javascript)
 vehicle = {
@@ -32,3 +35,31 @@ def allowed_vehicle_types(vehicle_type):
     """
     if not vehicle_type.casefold() in map(str.casefold, vehicle["types"]):
         raise ValidationError("Must be one of: " + ", ".join(vehicle["types"]))
+
+
+def validate_bbox(value):
+    """
+    Checks a bounding box: min lon, min lat, max lon, max lat (WGS84).
+    To be used in a marshmallow Schema
+    The bounding box must overlap with Amsterdam (bbox_adam), it may
+    extend beyond it, e.g. the viewport of a map near the city border
+    """
+    if len(value) != 4:
+        raise ValidationError(
+            "Must be 4 numbers: min lon, min lat, max lon, max lat"
+        )
+
+    min_lon, min_lat, max_lon, max_lat = value
+
+    if min_lon >= max_lon or min_lat >= max_lat:
+        raise ValidationError(
+            "Minimum values must be lower than maximum values"
+        )
+
+    if (
+        max_lon < bbox_adam["lon"]["min"]
+        or min_lon > bbox_adam["lon"]["max"]
+        or max_lat < bbox_adam["lat"]["min"]
+        or min_lat > bbox_adam["lat"]["max"]
+    ):
+        raise ValidationError("Must overlap with Amsterdam")
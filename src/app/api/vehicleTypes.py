@@ -1,3 +1,5 @@
+from ..routing import Vehicle
+
 #
 # Helper functions for determining vehicle types
 #
@@ -9,3 +11,30 @@ def vehicle_is_bus(vehicle_type):
 
 def vehicle_is_company_car(vehicle_type):
     return vehicle_type.lower() == "bedrijfsauto"
+
+
+def routing_vehicle(
+    vehicle_type,
+    vehicle_length,
+    vehicle_width,
+    vehicle_has_trailer,
+    vehicle_height,
+    vehicle_axle_weight,
+    vehicle_total_weight,
+    vehicle_max_allowed_weight,
+):
+    """
+    Vehicle properties as used by the routing graph
+    :return: Vehicle
+    """
+    return Vehicle(
+        is_bus=vehicle_is_bus(vehicle_type),
+        is_company_car=vehicle_is_company_car(vehicle_type),
+        has_trailer=vehicle_has_trailer,
+        length=vehicle_length,
+        width=vehicle_width,
+        height=vehicle_height,
+        axle_weight=vehicle_axle_weight,
+        total_weight=vehicle_total_weight,
+        max_allowed_weight=vehicle_max_allowed_weight,
+    )
@@ -0,0 +1,258 @@
+from concurrent.futures import Future
+import os
+import threading
+import time
+
+from .cache_store import MemoryStore, SHARED_CACHE_FILE, SQLiteStore
+
+# All caches and other in-memory data which must be discarded when the
+# data in the database changes
+_caches = []
+_listeners = []
+
+
+class Cache:
+    """
+    A thread-safe cache with a maximum number of entries. When full, the
+    least recently used entry is evicted. Entries expire after ttl
+    seconds. Entries are kept in memory, or for caches created with
+    shared=True in the store set by the CACHE_BACKEND setting, see
+    cache_store.
+
+    Values computed with get_or_compute are computed once per key, also
+    by concurrent requests. Caches created with stale=True keep serving
+    expired entries for CACHE_STALE_TTL seconds while the value is
+    computed again in the background.
+    """
+
+    def __init__(
+        self, name, maxsize, ttl=None, tables=None, stale=False, shared=False
+    ):
+        """
+        :param name: string - name of the cache
+        :param maxsize: int - maximum number of entries
+        :param ttl: int - seconds after which entries expire, defaults
+            to the CACHE_TTL setting
+        :param tables: iterable of strings - the tables (of the
+            bereikbaarheid schema) the cached data is derived from, the
+            cache is cleared when one of them changes. Defaults to all.
+        :param stale: boolean - serve expired entries while they are
+            refreshed, see get_or_compute
+        :param shared: boolean - share the entries with the other worker
+            processes if CACHE_BACKEND is sqlite. Keys must have the same
+            repr in every process, and values must be picklable.
+        """
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.tables = frozenset(tables) if tables is not None else None
+        self.stale = stale
+        self.shared = shared
+        self.default_ttl = 3600
+        self.stale_ttl = 0
+        self.store = MemoryStore(maxsize)
+
+        self._pending = {}
+        self._lock = threading.Lock()
+
+        # incremented when the cache is cleared, values computed before
+        # are not stored
+        self._generation = 0
+
+        _caches.append(self)
+
+    def get(self, key):
+        """
+        :param key: a hashable key
+        :return: the cached value, or None if there is no (valid) entry
+        """
+        entry = self.store.get(key)
+
+        if entry is None:
+            return None
+
+        value, expires = entry
+        now = time.time()
+
+        if expires < now:
+            if expires + self.stale_ttl < now:
+                self.store.delete(key)
+
+            return None
+
+        return value
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the cached value, or computes it. A value is computed once
+        at a time per key (per process): concurrent callers wait for the
+        computation and get its result. Expired entries which are not
+        older than stale_ttl are returned right away, while they are
+        computed again in a background thread.
+        :param key: a hashable key
+        :param compute: function without arguments - returns the value,
+            or None on errors (which are not cached). Runs in another
+            thread when refreshing an expired entry, so it should set up
+            its own application context.
+        :return: the value, or None on errors
+        """
+        entry = self.store.get(key)
+        now = time.time()
+
+        if entry is not None:
+            value, expires = entry
+
+            if expires >= now:
+                return value
+
+            if expires + self.stale_ttl >= now:
+                with self._lock:
+                    if key not in self._pending:
+                        self._pending[key] = Future()
+                        threading.Thread(
+                            target=self._compute,
+                            args=(
+                                key,
+                                compute,
+                                self._pending[key],
+                                self._generation,
+                            ),
+                            daemon=True,
+                        ).start()
+
+                return value
+
+        with self._lock:
+            future = self._pending.get(key)
+            computing = future is None
+
+            if computing:
+                future = self._pending[key] = Future()
+                generation = self._generation
+
+        if computing:
+            return self._compute(key, compute, future, generation)
+
+        return future.result()
+
+    def _compute(self, key, compute, future, generation):
+        """
+        Computes and caches a value for get_or_compute, and passes it on
+        to the callers waiting for it. The value is not cached if the
+        cache was cleared while computing, as it may be derived from data
+        which has changed since.
+        :param key: a hashable key
+        :param compute: function without arguments
+        :param future: Future - resolved with the value
+        :param generation: int - the generation of the cache when the
+            computation started
+        :return: the value, or None on errors
+        """
+        value = None
+
+        try:
+            value = compute()
+
+            if value is not None:
+                with self._lock:
+                    if generation == self._generation:
+                        self.set(key, value)
+
+        except Exception as error:
+            print(f"Error while computing {self.name} cache entry: ", error)
+
+        finally:
+            with self._lock:
+                if self._pending.get(key) is future:
+                    del self._pending[key]
+
+            future.set_result(value)
+
+        return value
+
+    def set(self, key, value):
+        """
+        :param key: a hashable key
+        :param value: the value to cache, must not be None
+        """
+        ttl = self.ttl if self.ttl is not None else self.default_ttl
+
+        self.store.set(key, value, time.time() + ttl)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._pending.clear()
+            self.store.clear()
+
+
+def on_invalidate(listener, tables=None):
+    """
+    Registers a function to be called when the caches are invalidated,
+    e.g. for discarding data loaded from the database
+    :param listener: function without arguments
+    :param tables: iterable of strings - the tables the data is derived
+        from, see Cache. Defaults to all.
+    """
+    _listeners.append(
+        (listener, frozenset(tables) if tables is not None else None)
+    )
+
+
+def invalidate(tables=None):
+    """
+    Empties the caches derived from tables which have changed, e.g. after
+    the bereikbaarheid materialized views are refreshed.
+    :param tables: iterable of strings - the changed tables, defaults to
+        all tables
+    """
+    changed = frozenset(tables) if tables is not None else None
+
+    for cache in _caches:
+        if depends_on(cache.tables, changed):
+            cache.clear()
+
+    for listener, listener_tables in _listeners:
+        if depends_on(listener_tables, changed):
+            listener()
+
+
+def depends_on(tables, changed):
+    """
+    :param tables: frozenset - tables data is derived from, None for all
+    :param changed: frozenset - changed tables, None for all
+    :return: boolean - True if the data is affected by the changes
+    """
+    if tables is None or changed is None:
+        return True
+
+    return bool(tables & changed)
+
+
+def init_app(app):
+    """Apply the cache settings of the Flask app. This is called by the
+    application factory.
+    """
+    shared_path = None
+
+    if app.config["CACHE_BACKEND"] == "sqlite":
+        if app.config["CACHE_DIR"]:
+            shared_path = os.path.join(
+                app.config["CACHE_DIR"], SHARED_CACHE_FILE
+            )
+        else:
+            print("The sqlite cache backend requires CACHE_DIR")
+
+    for cache in _caches:
+        cache.default_ttl = app.config["CACHE_TTL"]
+
+        if cache.stale:
+            cache.stale_ttl = app.config["CACHE_STALE_TTL"]
+
+        if cache.shared and shared_path is not None:
+            cache.store = SQLiteStore(
+                shared_path,
+                cache.name,
+                cache.maxsize,
+                app.config["CACHE_MAX_SIZE"] * 1024 * 1024,
+            )
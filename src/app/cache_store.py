@@ -0,0 +1,255 @@
+from collections import OrderedDict
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+# Name of the SQLiteStore database file in CACHE_DIR
+SHARED_CACHE_FILE = "shared-cache.sqlite"
+
+# The last access time of SQLite entries, used for evicting the least
+# recently used entries, is updated at most once per this many seconds,
+# so cache hits rarely write to the database
+ACCESS_RESOLUTION = 60
+
+
+class MemoryStore:
+    """
+    Stores the entries of a Cache in memory, in this process only. When
+    full, the least recently used entry is evicted.
+    """
+
+    def __init__(self, maxsize):
+        """
+        :param maxsize: int - maximum number of entries
+        """
+        self.maxsize = maxsize
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param key: a hashable key
+        :return: tuple - the value and the time (time.time()) at which it
+            expires, or None if there is no entry
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+            return entry
+
+    def set(self, key, value, expires):
+        """
+        :param key: a hashable key
+        :param value: the value
+        :param expires: float - time (time.time()) at which it expires
+        """
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteStore:
+    """
+    Stores the entries of a Cache in a SQLite database file, which is
+    shared by all processes using the same file, e.g. the gunicorn
+    workers on a node. Values are pickled, keys are stored as a hash of
+    their repr, so keys must have the same repr in every process. When the
+    cache has more than maxsize entries, or the database holds more than
+    max_bytes of values (of all caches), the least recently used entries
+    are evicted.
+    """
+
+    def __init__(self, path, name, maxsize, max_bytes):
+        """
+        :param path: string - path of the database file
+        :param name: string - name of the cache
+        :param maxsize: int - maximum number of entries of the cache
+        :param max_bytes: int - maximum size of the values of all caches
+            in the database
+        """
+        self.path = path
+        self.name = name
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+
+        # connections can't be shared between threads or (forked)
+        # processes
+        self._connections = threading.local()
+
+    def connection(self):
+        """
+        :return: sqlite3.Connection - the connection of this thread,
+            which is opened on first use
+        """
+        conn = getattr(self._connections, "conn", None)
+
+        if conn is None or self._connections.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("pragma journal_mode=wal")
+            conn.execute("pragma synchronous=normal")
+            conn.execute(
+                """
+                create table if not exists entries (
+                    cache text not null,
+                    key text not null,
+                    value blob not null,
+                    size integer not null,
+                    expires real not null,
+                    accessed real not null,
+                    primary key (cache, key)
+                )
+                """
+            )
+
+            self._connections.conn = conn
+            self._connections.pid = os.getpid()
+
+        return conn
+
+    def get(self, key):
+        """
+        :param key: a hashable key, with the same repr in every process
+        :return: tuple - the value and the time (time.time()) at which it
+            expires, or None if there is no entry
+        """
+        try:
+            conn = self.connection()
+            entry = conn.execute(
+                """
+                select value, expires, accessed from entries
+                where cache = ? and key = ?
+                """,
+                (self.name, store_key(key)),
+            ).fetchone()
+
+            if entry is None:
+                return None
+
+            value, expires, accessed = entry
+            now = time.time()
+
+            if accessed < now - ACCESS_RESOLUTION:
+                conn.execute(
+                    """
+                    update entries set accessed = ?
+                    where cache = ? and key = ?
+                    """,
+                    (now, self.name, store_key(key)),
+                )
+
+            return pickle.loads(value), expires
+
+        except (sqlite3.Error, pickle.UnpicklingError) as error:
+            print(f"Error while reading {self.name} cache entry: ", error)
+
+    def set(self, key, value, expires):
+        """
+        :param key: a hashable key, with the same repr in every process
+        :param value: the value, must be picklable
+        :param expires: float - time (time.time()) at which it expires
+        """
+        try:
+            value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            conn = self.connection()
+
+            conn.execute("begin immediate")
+
+            try:
+                conn.execute(
+                    "insert or replace into entries values (?, ?, ?, ?, ?, ?)",
+                    (
+                        self.name,
+                        store_key(key),
+                        value,
+                        len(value),
+                        expires,
+                        time.time(),
+                    ),
+                )
+                self.evict(conn)
+                conn.execute("commit")
+
+            except Exception:
+                conn.execute("rollback")
+                raise
+
+        except (sqlite3.Error, pickle.PicklingError) as error:
+            print(f"Error while storing {self.name} cache entry: ", error)
+
+    def evict(self, conn):
+        """
+        Removes the least recently used entries of the cache beyond
+        maxsize, and of all caches beyond max_bytes
+        :param conn: sqlite3.Connection - in a transaction
+        """
+        conn.execute(
+            """
+            delete from entries
+            where cache = ? and key in (
+                select key from entries
+                where cache = ?
+                order by accessed desc
+                limit -1 offset ?
+            )
+            """,
+            (self.name, self.name, self.maxsize),
+        )
+
+        conn.execute(
+            """
+            delete from entries
+            where (cache, key) in (
+                select cache, key from (
+                    select cache, key, sum(size) over (
+                        order by accessed desc, cache, key
+                    ) as total
+                    from entries
+                )
+                where total > ?
+            )
+            """,
+            (self.max_bytes,),
+        )
+
+    def delete(self, key):
+        try:
+            self.connection().execute(
+                "delete from entries where cache = ? and key = ?",
+                (self.name, store_key(key)),
+            )
+        except sqlite3.Error as error:
+            print(f"Error while removing {self.name} cache entry: ", error)
+
+    def clear(self):
+        try:
+            self.connection().execute(
+                "delete from entries where cache = ?", (self.name,)
+            )
+        except sqlite3.Error as error:
+            print(f"Error while clearing {self.name} cache: ", error)
+
+
+def store_key(key):
+    """
+    :param key: a hashable key
+    :return: string - the key of a SQLiteStore entry
+    """
+    return hashlib.sha1(repr(key).encode()).hexdigest()
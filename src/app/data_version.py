@@ -0,0 +1,214 @@
+import hashlib
+import os
+import select
+import threading
+import time
+
+import psycopg2
+from psycopg2 import sql
+
+from . import cache
+from .db import connect_kwargs
+
+# Tables (of the bereikbaarheid schema) of which the changes are tracked
+TRACKED_TABLES = (
+    "out_vma_directed",
+    "out_vma_node",
+    "out_vma_undirected",
+    "bd_stremmingen",
+    "bd_verkeersborden",
+    "bd_verkeerspalen",
+    "bd_venstertijdwegen",
+)
+
+# Channel for notifying the workers of changed tables, with the name of
+# the table as payload, or an empty payload for all tables:
+#   NOTIFY bereikbaarheid_data, 'bd_stremmingen';
+NOTIFY_CHANNEL = "bereikbaarheid_data"
+
+# Response header with the current data version
+VERSION_HEADER = "X-Data-Version"
+
+_versions = {}
+_version = None
+_lock = threading.Lock()
+_listener = None
+_listener_pid = None
+
+
+def query_table_versions(conn):
+    """
+    Versions of the tracked tables, from the Postgres catalog: the file of
+    a table (or materialized view) changes when it is rewritten, e.g. by
+    REFRESH MATERIALIZED VIEW or TRUNCATE, and the statistics count the
+    inserted, updated and deleted rows
+    :param conn: a psycopg2 connection
+    :return: dict - version per table name
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """
+            select c.relname,
+                c.relfilenode,
+                coalesce(s.n_tup_ins + s.n_tup_upd + s.n_tup_del, 0)
+            from pg_class c
+
+            inner join pg_namespace n
+            on n.oid = c.relnamespace
+
+            left join pg_stat_all_tables s
+            on s.relid = c.oid
+            where n.nspname = 'bereikbaarheid'
+            and c.relname = any(%(tables)s)
+            """,
+            {"tables": list(TRACKED_TABLES)},
+        )
+
+        return {name: f"{file}-{rows}" for name, file, rows in cursor}
+
+
+def update_versions(versions, notified=()):
+    """
+    Stores the current table versions, and invalidates the caches derived
+    from tables which have changed since the previous versions. The data
+    version only depends on the table versions, so all workers report the
+    same version for the same data.
+    :param versions: dict - version per table, see query_table_versions
+    :param notified: iterable of strings - tables which are reported as
+        changed, their caches are invalidated also when their version is
+        the same (yet)
+    """
+    global _version
+
+    with _lock:
+        changed = {
+            table
+            for table in set(versions) | set(_versions)
+            if versions.get(table) != _versions.get(table)
+        }
+
+        # the first versions are not a change
+        if not _versions:
+            changed = set()
+
+        if changed or _version is None:
+            _versions.clear()
+            _versions.update(versions)
+            _version = hashlib.md5(
+                ",".join(
+                    f"{table}={versions[table]}" for table in sorted(versions)
+                ).encode()
+            ).hexdigest()[:12]
+
+        changed |= set(notified)
+
+    if changed:
+        cache.invalidate(changed)
+
+
+def notified_tables(conn):
+    """
+    :param conn: a psycopg2 connection listening to NOTIFY_CHANNEL
+    :return: set of strings - the tables of the received notifications
+    """
+    conn.poll()
+    tables = set()
+
+    while conn.notifies:
+        payload = conn.notifies.pop(0).payload
+
+        if payload in TRACKED_TABLES:
+            tables.add(payload)
+        else:
+            tables.update(TRACKED_TABLES)
+
+    return tables
+
+
+def listen(config):
+    """
+    Tracks the data version, on a dedicated database connection. The
+    versions are checked when a notification arrives, and every
+    DATA_VERSION_INTERVAL seconds for changes without a notification.
+    :param config: the Flask app config
+    """
+    interval = config["DATA_VERSION_INTERVAL"]
+
+    while True:
+        conn = None
+
+        try:
+            conn = psycopg2.connect(**connect_kwargs(config))
+            conn.autocommit = True
+
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    sql.SQL("LISTEN {}").format(sql.Identifier(NOTIFY_CHANNEL))
+                )
+
+            update_versions(query_table_versions(conn))
+
+            while True:
+                if select.select([conn], [], [], interval) == ([], [], []):
+                    update_versions(query_table_versions(conn))
+                else:
+                    tables = notified_tables(conn)
+                    update_versions(query_table_versions(conn), tables)
+
+        except Exception as error:
+            print("Error while tracking the data version: ", error)
+
+        finally:
+            if conn is not None:
+                conn.close()
+
+        time.sleep(interval)
+
+
+def start_listener(app):
+    """
+    Starts tracking the data version in a background thread, once per
+    (forked) worker process
+    :param app: the Flask app
+    """
+    global _listener, _listener_pid
+
+    if not app.config["DATA_VERSION_INTERVAL"]:
+        return
+
+    if _listener is not None and _listener_pid == os.getpid():
+        return
+
+    with _lock:
+        if _listener is None or _listener_pid != os.getpid():
+            _listener = threading.Thread(
+                target=listen, args=(app.config,), daemon=True
+            )
+            _listener_pid = os.getpid()
+            _listener.start()
+
+
+def data_version():
+    """
+    :return: string - the current data version, or None if it is unknown
+    """
+    return _version
+
+
+def init_app(app):
+    """Track the data version of the Flask app. This is called by the
+    application factory.
+    """
+
+    @app.before_request
+    def start_data_version_listener():
+        start_listener(app)
+
+    @app.after_request
+    def add_version_header(response):
+        version = data_version()
+
+        if version is not None:
+            response.headers[VERSION_HEADER] = version
+
+        return response
@@ -1,53 +1,198 @@
+import os
+import threading
+import uuid
+
 from flask import current_app, g
 import psycopg2
+from psycopg2 import extras, pool
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class ConnectionPool:
+    """
+    A bounded pool of database connections, shared by all threads of a
+    worker process. Threads wait for a free connection when the pool is
+    exhausted. Borrowed connections are health-checked, so connections
+    broken by e.g. a database failover are replaced transparently.
+    """
+
+    def __init__(self, minconn, maxconn, timeout, **connect_kwargs):
+        self.pid = os.getpid()
+        self._pool = pool.ThreadedConnectionPool(
+            minconn, maxconn, **connect_kwargs
+        )
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._timeout = timeout
+
+    def getconn(self):
+        if not self._slots.acquire(timeout=self._timeout):
+            raise pool.PoolError("no database connection available")
+
+        try:
+            conn = self._pool.getconn()
+
+            if not connection_is_usable(conn):
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+        return conn
+
+    def putconn(self, conn, close=False):
+        try:
+            self._pool.putconn(conn, close=close or bool(conn.closed))
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        self._pool.closeall()
+
+
+def connection_is_usable(conn):
+    """
+    Checks if a pooled connection can still be used
+    :param conn: a psycopg2 connection
+    :return: boolean - False if the connection is closed or broken
+    """
+    if conn.closed:
+        return False
+
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("select 1")
+        conn.rollback()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        return False
+
+    return True
+
+
+def connect_kwargs(config):
+    """
+    :param config: the Flask app config
+    :return: dict - the psycopg2.connect arguments for the database
+    """
+    return {
+        "database": config["DB_NAME"],
+        "user": config["DB_USER"],
+        "password": config["DB_PWD"],
+        "host": config["DB_HOST"],
+        "port": config["DB_PORT"],
+        "sslmode": config["DB_SSL"],
+    }
+
+
+def get_pool():
+    """Returns the connection pool of the current process. The pool is
+    created on first use, so each (forked) gunicorn worker gets its own.
+    """
+    global _pool
+
+    if _pool is None or _pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                _pool = ConnectionPool(
+                    current_app.config["DB_POOL_MIN"],
+                    current_app.config["DB_POOL_MAX"],
+                    current_app.config["DB_POOL_TIMEOUT"],
+                    **connect_kwargs(current_app.config),
+                )
+
+    return _pool
 
 
 def get_db():
-    """Connect to the application's configured database. The connection
-    is unique for each request and will be reused if this is called again.
+    """Borrow a connection from the application's connection pool. The
+    connection is unique for each request and will be reused if this is
+    called again.
     """
     if "db" not in g:
-        g.db = psycopg2.connect(
-            database=current_app.config["DB_NAME"],
-            user=current_app.config["DB_USER"],
-            password=current_app.config["DB_PWD"],
-            host=current_app.config["DB_HOST"],
-            port=current_app.config["DB_PORT"],
-            sslmode=current_app.config["DB_SSL"],
-        )
+        g.db = get_pool().getconn()
 
     return g.db
 
 
 def close_db(e=None):
     """
-    If this request connected to the database, close the connection.
+    If this request borrowed a database connection, return it to the pool.
     """
     db = g.pop("db", None)
 
     if db is not None:
-        db.close()
+        get_pool().putconn(db)
 
 
-def query_db(query, query_params, fetch_one=False):
+def cursor(name=None, raw_json=False):
+    """
+    Creates a cursor on the connection of the current request
+    :param name: name for a server side cursor, optional
+    :param raw_json: if json values should be returned as strings instead
+        of being parsed, defaults to False
+    :return: the cursor
+    """
+    db_cursor = get_db().cursor(name=name)
+
+    if raw_json:
+        extras.register_default_json(db_cursor, loads=str)
+        extras.register_default_jsonb(db_cursor, loads=str)
+
+    return db_cursor
+
+
+def execute(query, query_params, cursor_name=None, raw_json=False):
+    """
+    Executes a query on the connection of the current request. If the
+    connection was lost (e.g. after a database failover) it is replaced
+    by a new one and the query is executed once more.
+    :param query: the SQL query
+    :param query_params: a dict with named arguments
+    :param cursor_name: name for a server side cursor, optional
+    :param raw_json: see cursor
+    :return: the cursor holding the results
+    """
+    try:
+        db_cursor = cursor(cursor_name, raw_json)
+        db_cursor.execute(query, query_params)
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        # only retry on a borrowed connection which was lost, not when no
+        # connection could be made
+        db = g.get("db")
+
+        if db is None or not db.closed:
+            raise
+
+        close_db()
+        db_cursor = cursor(cursor_name, raw_json)
+        db_cursor.execute(query, query_params)
+
+    return db_cursor
+
+
+def query_db(query, query_params, fetch_one=False, raw_json=False):
     """
     Query the database
     :param query: the SQL query
     :param query_params: a dict with named arguments
     :param fetch_one: if one result should be fetched, defaults to False
+    :param raw_json: if json columns should be returned as (serialized)
+        strings instead of Python objects, defaults to False. Useful when
+        the json is passed on as is, e.g. GeoJSON features.
     :return: the query results
 
     Debug queries with:
         print(cursor.mogrify(query, query_params).decode("utf-8"))
     """
     try:
-        cursor = get_db().cursor()
-        cursor.execute(query, query_params)
+        db_cursor = execute(query, query_params, raw_json=raw_json)
 
         if fetch_one:
-            return cursor.fetchone()
+            return db_cursor.fetchone()
 
-        return cursor.fetchall()
+        return db_cursor.fetchall()
 
     except (Exception, psycopg2.DatabaseError) as error:
         print("Error: no connection or error in query: ", error)
@@ -55,6 +200,37 @@ def query_db(query, query_params, fetch_one=False):
         raise Exception
 
 
+def query_db_stream(query, query_params, batch_size=1000, raw_json=False):
+    """
+    Query the database with a server side cursor, which fetches the
+    results in batches instead of all at once
+    :param query: the SQL query
+    :param query_params: a dict with named arguments
+    :param batch_size: number of rows fetched at a time
+    :param raw_json: see query_db
+    :return: a generator of the query results
+
+    The connection is used until the generator is exhausted, so use
+    flask.stream_with_context when streaming the results in a response.
+    """
+    try:
+        db_cursor = execute(
+            query, query_params, f"stream_{uuid.uuid4().hex}", raw_json
+        )
+        db_cursor.itersize = batch_size
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        print("Error: no connection or error in query: ", error)
+        # re-raise exception so API endpoint using this can add HTTP messages
+        raise Exception
+
+    def rows():
+        with db_cursor:
+            yield from db_cursor
+
+    return rows()
+
+
 def init_app(app):
     """Register database functions with the Flask app. This is called by
     the application factory.
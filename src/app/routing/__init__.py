@@ -0,0 +1,10 @@
+from .graph import (
+    START_NODE,
+    Vehicle,
+    VehicleClass,
+    RoutingGraph,
+    get_graph,
+)
+from .bollards import BollardNetwork, get_bollard_network
+from .commands import init_app
+from .spatial import Snap, SpatialIndex, get_spatial_index
@@ -0,0 +1,508 @@
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+import heapq
+import math
+import threading
+
+import numpy as np
+from scipy.sparse.csgraph import dijkstra
+
+from ..cache import on_invalidate
+from ..db import query_db
+from .graph import START_NODE, edges_csr, find_node_index, index_edges
+from .spatial import get_spatial_index
+
+# Costs which make routes avoid bollards: the cost of road sections of
+# the car network with a bollard is multiplied by BOLLARD_FACTOR, other
+# road sections cost NOT_ACCESSIBLE_COST, or twice as much when they have
+# a bollard which is closed
+BOLLARD_FACTOR = 10000
+NOT_ACCESSIBLE_COST = 10000 * 10000
+
+# Number of cost networks (day of the week and time buckets) which are
+# kept in memory, and the number of them for which the shortest path tree
+# from the START_NODE is kept in memory as well
+BOLLARD_NETWORKS_CACHE_SIZE = 32
+START_TREES_CACHE_SIZE = 8
+
+# A search towards a destination stops after settling this fraction of
+# the nodes, routing to all nodes at once in scipy is faster by then
+SEARCH_NODES_FRACTION = 0.1
+
+_network = None
+_network_lock = threading.Lock()
+
+
+class BollardNetwork:
+    """
+    The network for routing to a location along as few bollards as
+    possible: the car network and the road sections with time windows
+    (bereikbaarheid.bd_venstertijdwegen) of out_vma_directed, with one
+    edge per bollard (bereikbaarheid.bd_verkeerspalen) on a road section.
+
+    The cost of the edges only depends on the day of the week and on the
+    position of the time window relative to the start and end times of
+    the bollards. Requests within the same time buckets share the same
+    cost network.
+
+    Routes are searched with A*, with the straight line distance (RD New)
+    to the destination as heuristic, so only the corridor towards the
+    destination is explored. Far away destinations fall back to the
+    shortest path tree from the START_NODE, which is cached.
+    """
+
+    def __init__(self, rows, destinations, node_coordinates=None):
+        """
+        :param rows: list of tuples - id, source, target, cost and
+            car_network of the road sections, with the days, start time
+            and end time of the bollard (or None) and if the road section
+            has a bollard
+        :param destinations: list of tuples - road element id and the
+            node to route to for the road element
+        :param node_coordinates: tuple of arrays - optional, node ids and
+            their x, y in RD New (EPSG:28992), for the A* heuristic
+        """
+        destinations = sorted(destinations)
+        self.road_element_ids = np.array(
+            [i[0] for i in destinations], dtype=np.int64
+        )
+        self.destination_nodes = np.array(
+            [i[1] for i in destinations], dtype=np.int64
+        )
+
+        columns = list(zip(*rows)) if rows else [()] * 9
+
+        edges = index_edges(columns[0], columns[1], columns[2])
+        order = edges.order
+
+        self.node_ids = edges.node_ids
+        self.indptr = edges.indptr
+        self.edge_ids = edges.edge_ids
+        self.sources = edges.sources
+        self.targets = edges.targets
+
+        # null values are stored as NaN, like out_vma_directed.cost
+        self.cost = np.array(columns[3], dtype=np.float64)[order]
+        self.car_network = np.array(
+            [i is True for i in columns[4]], dtype=bool
+        )[order]
+        self.not_car_network = np.array(
+            [i is False for i in columns[4]], dtype=bool
+        )[order]
+        self.has_bollard = np.array(columns[8], dtype=bool)[order]
+
+        days = [columns[5][i] or [] for i in order]
+        begin = [columns[6][i] for i in order]
+        end = [columns[7][i] for i in order]
+
+        # a bollard is closed on a day if any of its days differs from it,
+        # so on days none of the bollards has if it has any day
+        self.day_closed = {
+            day: np.array(
+                [any(i is not None and i != day for i in j) for j in days],
+                dtype=bool,
+            )
+            for day in {i for j in days for i in j if i is not None}
+        }
+        self.has_days = np.array(
+            [any(i is not None for i in j) for j in days], dtype=bool
+        )
+
+        # the start and end times as rank in the distinct start and end
+        # times, -1 and len(end_times) for null values, so comparisons
+        # with a time become comparisons with its time bucket
+        self.begin_times = sorted({i for i in begin if i is not None})
+        self.end_times = sorted({i for i in end if i is not None})
+        begin_rank = {value: i for i, value in enumerate(self.begin_times)}
+        end_rank = {value: i for i, value in enumerate(self.end_times)}
+
+        self.begin_ranks = np.array(
+            [begin_rank[i] if i is not None else -1 for i in begin],
+            dtype=np.int64,
+        )
+        self.end_ranks = np.array(
+            [end_rank[i] if i is not None else len(end_rank) for i in end],
+            dtype=np.int64,
+        )
+
+        # coordinates per node index, NaN if unknown
+        self.node_xy = np.full((len(self.node_ids), 2), np.nan)
+
+        if node_coordinates is not None:
+            ids, xy = node_coordinates
+            known = np.isin(self.node_ids, ids)
+            order = np.argsort(ids)
+            self.node_xy[known] = xy[
+                order[np.searchsorted(ids, self.node_ids[known], sorter=order)]
+            ]
+
+        # the edge lengths in a straight line, for the A* heuristic. The
+        # heuristic is only a lower bound if all nodes have coordinates,
+        # otherwise it is not used (all lengths 0).
+        if np.isnan(self.node_xy).any():
+            self.edge_distances = np.zeros(len(self.edge_ids))
+        else:
+            self.edge_distances = np.hypot(
+                *(self.node_xy[self.targets] - self.node_xy[self.sources]).T
+            )
+
+        # plain lists, which are faster to index in the A* search loop
+        self.indptr_list = self.indptr.tolist()
+        self.targets_list = self.targets.tolist()
+
+        self.cost_network = lru_cache(BOLLARD_NETWORKS_CACHE_SIZE)(
+            self._cost_network
+        )
+        self.start_tree = lru_cache(START_TREES_CACHE_SIZE)(self._start_tree)
+
+    def node_index(self, node_id):
+        """
+        :param node_id: int - id of a node in out_vma_node
+        :return: int - index of the node, or None if it is not in the graph
+        """
+        return find_node_index(self.node_ids, node_id)
+
+    def cost_key(self, day_of_the_week, time_from, time_to):
+        """
+        Requests with the same cost key are routed over the same costs
+        :param day_of_the_week: string - e.g "di", or None
+        :param time_from: time - e.g 08:00, or None
+        :param time_to: time - e.g 16:00, or None
+        :return: tuple - the day and the time buckets of time_from and
+            time_to
+        """
+        # bollards with a start time from this bucket on are closed
+        from_bucket = (
+            bisect_left(self.begin_times, time_from)
+            if time_from is not None
+            else len(self.begin_times)
+        )
+
+        # bollards with an end time before this bucket are closed
+        to_bucket = (
+            bisect_right(self.end_times, time_to) if time_to is not None else 0
+        )
+
+        return day_of_the_week, from_bucket, to_bucket
+
+    def weights(self, day_of_the_week, from_bucket, to_bucket):
+        """
+        :param day_of_the_week: string - see cost_key
+        :param from_bucket: int - see cost_key
+        :param to_bucket: int - see cost_key
+        :return: float array - the cost of each edge
+        """
+        closed = (self.begin_ranks >= from_bucket) | (
+            self.end_ranks < to_bucket
+        )
+
+        if day_of_the_week is not None:
+            closed |= self.day_closed.get(day_of_the_week, self.has_days)
+
+        weights = np.where(
+            self.car_network & (closed | self.has_bollard),
+            self.cost * BOLLARD_FACTOR,
+            self.cost,
+        )
+        weights[self.not_car_network] = NOT_ACCESSIBLE_COST
+        weights[self.not_car_network & closed] = 2 * NOT_ACCESSIBLE_COST
+
+        return weights
+
+    def _cost_network(self, day_of_the_week, from_bucket, to_bucket):
+        """
+        Results are cached, use cost_network to call this.
+        :param day_of_the_week: string - see cost_key
+        :param from_bucket: int - see cost_key
+        :param to_bucket: int - see cost_key
+        :return: tuple - the cost of each edge, as array and as list, and
+            the lowest cost per meter (in a straight line) of the edges
+        """
+        weights = self.weights(day_of_the_week, from_bucket, to_bucket)
+
+        # like pgRouting, edges with a negative (or null) cost are left
+        # out, these are stored as NaN
+        with np.errstate(invalid="ignore"):
+            weights[~(weights >= 0)] = np.nan
+            measured = (self.edge_distances > 0) & ~np.isnan(weights)
+
+        # no route to a node is cheaper than its distance to the
+        # destination times this
+        cost_per_meter = (
+            float(np.min(weights[measured] / self.edge_distances[measured]))
+            if measured.any()
+            else 0.0
+        )
+        weights.flags.writeable = False
+
+        return weights, weights.tolist(), cost_per_meter
+
+    def _start_tree(self, day_of_the_week, from_bucket, to_bucket):
+        """
+        The shortest path tree from the START_NODE. Results are cached,
+        use start_tree to call this.
+        :param day_of_the_week: string - see cost_key
+        :param from_bucket: int - see cost_key
+        :param to_bucket: int - see cost_key
+        :return: int array - the predecessor (node index, or a negative
+            number for the start node and unreachable nodes) per node index
+        """
+        weights, _, _ = self.cost_network(
+            day_of_the_week, from_bucket, to_bucket
+        )
+        n = len(self.node_ids)
+        source = self.node_index(START_NODE)
+
+        if source is None:
+            return np.full(n, -9999, dtype=np.int32)
+
+        routable = ~np.isnan(weights)
+
+        _, predecessors = dijkstra(
+            edges_csr(
+                self.sources[routable],
+                self.targets[routable],
+                weights[routable],
+                n,
+            ),
+            indices=source,
+            return_predecessors=True,
+        )
+        predecessors.flags.writeable = False
+
+        return predecessors
+
+    def destination_node(self, road_element_id):
+        """
+        :param road_element_id: int - id of a road element
+        :return: int - the target node of the road element in the
+            direction which can be used, or None
+        """
+        i = np.searchsorted(self.road_element_ids, road_element_id)
+
+        if (
+            i < len(self.road_element_ids)
+            and self.road_element_ids[i] == road_element_id
+        ):
+            return int(self.destination_nodes[i])
+
+        return None
+
+    def has_destination(self, road_element_ids):
+        """
+        :param road_element_ids: int array - ids of road elements
+        :return: boolean array - True for each road element which has a
+            destination_node, e.g. as mask for SpatialIndex.nearest_edge
+        """
+        return np.isin(road_element_ids, self.road_element_ids)
+
+    def route(self, target_node, day_of_the_week, time_from, time_to):
+        """
+        :param target_node: int - id of the node to route to, or None
+        :param day_of_the_week: string - e.g "di", or None
+        :param time_from: time - e.g 08:00, or None
+        :param time_to: time - e.g 16:00, or None
+        :return: list of ints - ids of the edges of the cheapest route from
+            the START_NODE, empty if there is no route
+        """
+        source = self.node_index(START_NODE)
+        target = (
+            self.node_index(target_node) if target_node is not None else None
+        )
+
+        if source is None or target is None or source == target:
+            return []
+
+        key = self.cost_key(day_of_the_week, time_from, time_to)
+        edges = self.search(source, target, *self.cost_network(*key))
+
+        if edges is None:
+            edges = self.tree_route(target, *key)
+
+        return [int(i) for i in self.edge_ids[edges]]
+
+    def search(self, source, target, weights, weights_list, cost_per_meter):
+        """
+        A* search for the cheapest route between two nodes
+        :param source: int - node index to start from
+        :param target: int - node index to route to
+        :param weights: float array - cost per edge, NaN if not routable
+        :param weights_list: list - weights as list
+        :param cost_per_meter: float - lower bound of the cost per meter,
+            for the heuristic
+        :return: list of ints - edge indices of the route, empty if there
+            is no route, or None if the search settled more than
+            SEARCH_NODES_FRACTION of the nodes
+        """
+        # the heuristic can't overestimate the remaining cost
+        heuristic = np.nan_to_num(
+            cost_per_meter * np.hypot(*(self.node_xy - self.node_xy[target]).T)
+        ).tolist()
+
+        indptr = self.indptr_list
+        targets = self.targets_list
+        max_settled = max(SEARCH_NODES_FRACTION * len(self.node_ids), 1)
+
+        costs = {source: 0.0}
+        predecessor_edges = {}
+        queue = [(heuristic[source], 0.0, source)]
+        settled = 0
+
+        while queue:
+            _, cost, node = heapq.heappop(queue)
+
+            if cost > costs[node]:
+                continue
+
+            if node == target:
+                break
+
+            settled += 1
+
+            if settled > max_settled:
+                return None
+
+            for edge in range(indptr[node], indptr[node + 1]):
+                weight = weights_list[edge]
+
+                # NaN for edges which can't be used
+                if weight != weight:
+                    continue
+
+                next_node = targets[edge]
+                next_cost = cost + weight
+
+                if next_cost < costs.get(next_node, math.inf):
+                    costs[next_node] = next_cost
+                    predecessor_edges[next_node] = edge
+                    heapq.heappush(
+                        queue,
+                        (
+                            next_cost + heuristic[next_node],
+                            next_cost,
+                            next_node,
+                        ),
+                    )
+
+        if target not in costs:
+            return []
+
+        edges = []
+        node = target
+
+        while node != source:
+            edges.append(predecessor_edges[node])
+            node = self.sources[predecessor_edges[node]]
+
+        return edges[::-1]
+
+    def tree_route(self, target, day_of_the_week, from_bucket, to_bucket):
+        """
+        The cheapest route from the START_NODE in its shortest path tree
+        :param target: int - node index to route to
+        :param day_of_the_week: string - see cost_key
+        :param from_bucket: int - see cost_key
+        :param to_bucket: int - see cost_key
+        :return: list of ints - edge indices of the route, empty if there
+            is no route
+        """
+        weights, _, _ = self.cost_network(
+            day_of_the_week, from_bucket, to_bucket
+        )
+        predecessors = self.start_tree(day_of_the_week, from_bucket, to_bucket)
+        node = target
+        edges = []
+
+        while predecessors[node] >= 0:
+            previous = int(predecessors[node])
+
+            # the cheapest of the (parallel) edges between the nodes
+            candidates = np.arange(
+                self.indptr[previous], self.indptr[previous + 1]
+            )
+            candidates = candidates[
+                (self.targets[candidates] == node)
+                & ~np.isnan(weights[candidates])
+            ]
+            edges.append(candidates[np.argmin(weights[candidates])])
+            node = previous
+
+        return edges[::-1]
+
+
+def query_bollard_network():
+    """
+    Loads the bollard network from the database
+    :return: BollardNetwork
+    """
+    db_query = """
+        select v.id, v.source, v.target, v.cost, v.car_network,
+            p.dagen, p.begin_tijd, p.eind_tijd,
+            p.paalnummer is not null
+        from bereikbaarheid.out_vma_directed v
+
+        left join bereikbaarheid.bd_verkeerspalen p
+        on abs(v.id) = abs(p.linknr)
+        where car_network = true
+        or abs(id) in (
+            select linknr from bereikbaarheid.bd_venstertijdwegen
+        )
+    """
+
+    # the target of the road element in the direction it can be driven
+    # in, preferably the positive direction
+    destinations_query = """
+        select distinct on (abs(id)) abs(id), target
+        from bereikbaarheid.out_vma_directed
+        where cost > 0 or car_network is false
+        order by abs(id), id desc
+    """
+
+    index = get_spatial_index()
+
+    return BollardNetwork(
+        query_db(db_query, {}),
+        query_db(destinations_query, {}),
+        (index.node_ids, index.arrays["node_xy"]),
+    )
+
+
+def get_bollard_network():
+    """
+    Returns the bollard network of this process, loading it on first use.
+    Must be called within an application context.
+    :return: BollardNetwork
+    """
+    global _network
+
+    loaded = _network
+
+    if loaded is None:
+        with _network_lock:
+            if _network is None:
+                _network = query_bollard_network()
+
+            loaded = _network
+
+    return loaded
+
+
+def reset_bollard_network():
+    """
+    Discards the bollard network, it is loaded again on next use
+    """
+    global _network
+
+    with _network_lock:
+        _network = None
+
+
+on_invalidate(
+    reset_bollard_network,
+    tables=[
+        "bd_venstertijdwegen",
+        "bd_verkeerspalen",
+        "out_vma_directed",
+        "out_vma_node",
+    ],
+)
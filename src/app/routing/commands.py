@@ -0,0 +1,45 @@
+import click
+from flask import current_app
+
+from .graph import query_graph, write_graph_snapshot
+from .snapshot import publish_snapshot, query_source_versions, write_sources
+from .spatial import query_spatial_index, write_spatial_snapshot
+
+
+@click.command("routing-snapshot")
+def routing_snapshot_command():
+    """Store the routing graph, the spatial index and the reachability
+    of common vehicles in a new snapshot. Run this after the
+    bereikbaarheid materialized views are refreshed, workers use the
+    snapshot when they (re)load the routing data.
+    """
+    directory = current_app.config["ROUTING_SNAPSHOT_DIR"]
+
+    if not directory:
+        raise click.ClickException("ROUTING_SNAPSHOT_DIR is not set")
+
+    # the versions from before loading, so a snapshot of data which
+    # changed while loading is considered outdated
+    versions = query_source_versions()
+    graph = query_graph()
+    index = query_spatial_index()
+    profiles = []
+
+    def write(path):
+        write_sources(path, versions)
+        write_spatial_snapshot(index, path)
+        profiles.append(write_graph_snapshot(graph, path))
+
+    path = publish_snapshot(directory, write)
+
+    click.echo(
+        f"Stored the routing data and the reachability of {profiles[0]} "
+        f"profiles in {path}"
+    )
+
+
+def init_app(app):
+    """Register routing commands with the Flask app. This is called by
+    the application factory.
+    """
+    app.cli.add_command(routing_snapshot_command)
@@ -0,0 +1,710 @@
+from collections import namedtuple
+from functools import lru_cache
+import os
+import threading
+
+from flask import current_app
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import breadth_first_order, dijkstra
+
+from ..cache import on_invalidate
+from ..db import query_db
+from .snapshot import (
+    current_snapshot,
+    current_snapshot_mtime,
+    read_arrays,
+    read_reachability,
+    snapshot_is_current,
+    write_arrays,
+    write_reachability,
+)
+
+# Node from which all reachability is calculated
+START_NODE = 902205
+
+# Traffic sign restrictions (RVV) of bereikbaarheid.out_vma_directed
+# c01, c07, c07a and c10 are booleans, c17 - c21 are maximum values
+# for the vehicle dimensions (in meters) and weights (in kilograms)
+BOOLEAN_RESTRICTIONS = ("c01", "c07", "c07a", "c10")
+THRESHOLD_RESTRICTIONS = ("c17", "c18", "c19", "c20", "c21")
+
+Vehicle = namedtuple(
+    "Vehicle",
+    [
+        "is_bus",
+        "is_company_car",
+        "has_trailer",
+        "length",
+        "width",
+        "height",
+        "axle_weight",
+        "total_weight",
+        "max_allowed_weight",
+    ],
+)
+
+# A vehicle class holds for c07, c07a and c10 if the restriction applies
+# to a vehicle, and for c17 - c21 the number of distinct maximum values
+# in the network which are exceeded by the vehicle. All vehicles of the
+# same class can access exactly the same edges.
+VehicleClass = namedtuple(
+    "VehicleClass",
+    ["c07", "c07a", "c10", "c17", "c18", "c19", "c20", "c21"],
+)
+
+# Edges sorted by source node, with their nodes mapped to indices, see
+# index_edges
+EdgeIndex = namedtuple(
+    "EdgeIndex",
+    ["node_ids", "indptr", "order", "edge_ids", "sources", "targets"],
+)
+
+# Number of vehicle classes for which the reachability is kept in memory
+REACHABILITY_CACHE_SIZE = 256
+
+# Number of sets of obstructed road elements for which the reachability
+# is kept in memory
+OBSTRUCTIONS_CACHE_SIZE = 64
+
+# Common vehicles for which the reachability is precomputed in snapshots,
+# both with and without the margins of vehicle_class
+SNAPSHOT_VEHICLES = (
+    # passenger car
+    Vehicle(False, False, False, 4.5, 1.8, 1.6, 1000, 2000, 2000),
+    # delivery van
+    Vehicle(False, True, False, 7, 2.2, 2.7, 2500, 3500, 3500),
+    # bus
+    Vehicle(True, False, False, 12, 2.55, 3.3, 11500, 19000, 19000),
+    # truck
+    Vehicle(False, True, False, 10, 2.55, 3.5, 10000, 18000, 18000),
+    # truck with trailer
+    Vehicle(False, True, True, 18.75, 2.55, 4, 11500, 40000, 50000),
+)
+
+_graph = None
+_graph_snapshot = None
+_graph_lock = threading.Lock()
+
+
+class RoutingGraph:
+    """
+    The directed road network (bereikbaarheid.out_vma_directed) stored
+    as compressed sparse row (CSR) arrays, for calculating routes in
+    process instead of in pgRouting.
+
+    Node ids are mapped to the indices 0..n-1 of the sorted node_ids
+    array. Edges are sorted by source node, so the outgoing edges of
+    node index i are the edges indptr[i] up to indptr[i + 1].
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+        self.node_ids = arrays["node_ids"]
+        self.indptr = arrays["indptr"]
+        self.edge_ids = arrays["edge_ids"]
+        self.sources = arrays["sources"]
+        self.targets = arrays["targets"]
+        self.cost = arrays["cost"]
+
+        # distinct maximum values per threshold restriction
+        self.thresholds = {
+            name: np.unique(arrays[name][~np.isnan(arrays[name])])
+            for name in THRESHOLD_RESTRICTIONS
+        }
+
+        self.class_unreachable_nodes = lru_cache(REACHABILITY_CACHE_SIZE)(
+            self._class_unreachable_nodes
+        )
+        self.start_tree = lru_cache(2)(self._start_tree)
+        self.obstructed_unreachable_nodes = lru_cache(OBSTRUCTIONS_CACHE_SIZE)(
+            self._obstructed_unreachable_nodes
+        )
+
+        # precomputed start_costs, see write_graph_snapshot
+        self.snapshot = None
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Builds the graph from out_vma_directed records
+        :param rows: list of tuples - id, source, target, cost followed by
+            the BOOLEAN_RESTRICTIONS and THRESHOLD_RESTRICTIONS columns
+        :return: RoutingGraph
+        """
+        columns = list(zip(*rows)) if rows else [()] * 13
+
+        edges = index_edges(columns[0], columns[1], columns[2])
+        order = edges.order
+
+        arrays = {
+            "node_ids": edges.node_ids,
+            "indptr": edges.indptr,
+            "edge_ids": edges.edge_ids,
+            "sources": edges.sources,
+            "targets": edges.targets,
+            # null values are stored as NaN
+            "cost": np.array(columns[3], dtype=np.float64)[order],
+        }
+
+        for i, name in enumerate(BOOLEAN_RESTRICTIONS, start=4):
+            arrays[name] = np.array(columns[i], dtype=bool)[order]
+
+        for i, name in enumerate(THRESHOLD_RESTRICTIONS, start=8):
+            arrays[name] = np.array(columns[i], dtype=np.float64)[order]
+
+        return cls(arrays)
+
+    def node_index(self, node_id):
+        """
+        :param node_id: int - id of a node in out_vma_node
+        :return: int - index of the node, or None if it is not in the graph
+        """
+        return find_node_index(self.node_ids, node_id)
+
+    def routable(self, positive_cost=False):
+        """
+        Edges which can be used for routing. Like pgRouting, edges with a
+        negative cost are left out.
+        :param positive_cost: boolean - also leave out edges with cost 0
+        :return: boolean array - True for each usable edge
+        """
+        with np.errstate(invalid="ignore"):
+            if positive_cost:
+                return self.cost > 0
+
+            return self.cost >= 0
+
+    def vehicle_class(self, vehicle, margins=False, strict=False):
+        """
+        Determines the class of a vehicle, based on the RVV traffic sign
+        restrictions it is subject to
+        :param vehicle: Vehicle
+        :param margins: boolean - allow vehicles which exceed a maximum
+            dimension by less than 1 cm or a maximum weight by less
+            than 1 kg, as done for /roads/prohibitory
+        :param strict: boolean - a maximum value is only exceeded if it is
+            smaller than the value of the vehicle, like the status codes
+            of /roads/prohibitory, instead of when it is not larger
+        :return: VehicleClass
+        """
+        dimension_margin, weight_margin = (0.01, 1) if margins else (0, 0)
+
+        limits = {
+            "c17": vehicle.length - dimension_margin,
+            "c18": vehicle.width - dimension_margin,
+            "c19": vehicle.height - dimension_margin,
+            "c20": vehicle.axle_weight - weight_margin,
+            "c21": vehicle.total_weight - weight_margin,
+        }
+
+        # a maximum value is exceeded if it is not larger than the limit,
+        # or if strict if it is smaller than the limit
+        side = "left" if strict else "right"
+        exceeded = {
+            name: int(np.searchsorted(self.thresholds[name], value, side=side))
+            for name, value in limits.items()
+        }
+
+        return VehicleClass(
+            c07=bool(
+                vehicle.is_company_car and vehicle.max_allowed_weight > 3500
+            ),
+            c07a=bool(vehicle.is_bus),
+            c10=bool(vehicle.has_trailer),
+            **exceeded,
+        )
+
+    def class_mask(self, vehicle_class):
+        """
+        Edges which are accessible for a class of vehicles
+        :param vehicle_class: VehicleClass
+        :return: boolean array - True for each accessible edge
+        """
+        arrays = self.arrays
+        mask = ~arrays["c01"]
+
+        for name in ("c07", "c07a", "c10"):
+            if getattr(vehicle_class, name):
+                mask &= ~arrays[name]
+
+        for name in THRESHOLD_RESTRICTIONS:
+            exceeded = getattr(vehicle_class, name)
+
+            if exceeded:
+                column = arrays[name]
+                with np.errstate(invalid="ignore"):
+                    mask &= np.isnan(column) | (
+                        column > self.thresholds[name][exceeded - 1]
+                    )
+
+        return mask
+
+    def vehicle_mask(self, vehicle, margins=False):
+        """
+        Edges which are accessible for a vehicle, based on the RVV
+        traffic sign restrictions
+        :param vehicle: Vehicle
+        :param margins: boolean - see vehicle_class
+        :return: boolean array - True for each accessible edge
+        """
+        return self.class_mask(self.vehicle_class(vehicle, margins))
+
+    def csr(self, mask, weights=None):
+        """
+        :param mask: boolean array - the edges to include
+        :param weights: array - edge weights, defaults to the edge cost
+        :return: scipy csr_matrix of the masked graph
+        """
+        n = len(self.node_ids)
+        indptr = np.concatenate(
+            ([0], np.cumsum(np.bincount(self.sources[mask], minlength=n)))
+        )
+        weights = self.cost if weights is None else weights
+
+        return csr_matrix(
+            (weights[mask], self.targets[mask], indptr), shape=(n, n)
+        )
+
+    def dijkstra_cost(self, source_node, mask, limit=np.inf):
+        """
+        Calculates the aggregated cost from a node to all other nodes
+        :param source_node: int - id of the start node
+        :param mask: boolean array - the edges to route over
+        :param limit: float - stop searching beyond this aggregated cost
+        :return: float array - cost per node index, inf if unreachable
+        """
+        source = self.node_index(source_node)
+
+        if source is None:
+            return np.full(len(self.node_ids), np.inf)
+
+        return dijkstra(self.csr(mask), indices=source, limit=limit)
+
+    def agg_costs(self, source_node, mask, limit=np.inf):
+        """
+        Same results as pgr_dijkstraCost from one node to all nodes: the
+        start node itself and unreachable nodes are not included
+        :param source_node: int - id of the start node
+        :param mask: boolean array - the edges to route over
+        :param limit: float - stop searching beyond this aggregated cost
+        :return: tuple of arrays - the reachable node ids and their cost
+        """
+        costs = self.dijkstra_cost(source_node, mask, limit)
+        reached = np.isfinite(costs) & (self.node_ids != source_node)
+
+        return self.node_ids[reached], costs[reached]
+
+    def unreachable_nodes(self, source_node, mask):
+        """
+        :param source_node: int - id of the start node
+        :param mask: boolean array - the edges to route over
+        :return: int array - ids of the nodes without a pgr_dijkstraCost
+            result, so including the start node itself
+        """
+        costs = self.dijkstra_cost(source_node, mask)
+        unreached = ~np.isfinite(costs) | (self.node_ids == source_node)
+
+        return self.node_ids[unreached]
+
+    def start_costs(self, vehicle_class=None, positive_cost=False):
+        """
+        Aggregated cost from the START_NODE to all nodes, taken from the
+        snapshot if it contains the profile
+        :param vehicle_class: VehicleClass - or None to ignore the traffic
+            sign restrictions
+        :param positive_cost: boolean - leave out edges with cost 0
+        :return: float array - cost per node index, inf if unreachable
+        """
+        if self.snapshot is not None:
+            costs = self.snapshot.profile_costs((positive_cost, vehicle_class))
+
+            if costs is not None:
+                return costs
+
+        mask = self.routable(positive_cost)
+
+        if vehicle_class is not None:
+            mask = mask & self.class_mask(vehicle_class)
+
+        return self.dijkstra_cost(START_NODE, mask)
+
+    def _class_unreachable_nodes(self, vehicle_class, positive_cost=False):
+        """
+        Nodes which a class of vehicles can not reach from the START_NODE.
+        Results are cached, use class_unreachable_nodes to call this.
+        :param vehicle_class: VehicleClass
+        :param positive_cost: boolean - leave out edges with cost 0
+        :return: int array - ids of the unreachable nodes, like
+            unreachable_nodes
+        """
+        costs = self.start_costs(vehicle_class, positive_cost)
+        unreached = ~np.isfinite(costs) | (self.node_ids == START_NODE)
+
+        unreachable = self.node_ids[unreached]
+        unreachable.flags.writeable = False
+
+        return unreachable
+
+    def _start_tree(self, positive_cost=False):
+        """
+        The shortest path tree from the START_NODE over all routable
+        edges, without traffic sign restrictions. Results are cached, use
+        start_tree to call this.
+        :param positive_cost: boolean - leave out edges with cost 0
+        :return: tuple of arrays - cost and predecessor (node index, or
+            a negative number for the start node and unreachable nodes)
+            per node index
+        """
+        source = self.node_index(START_NODE)
+
+        if source is None:
+            n = len(self.node_ids)
+            return np.full(n, np.inf), np.full(n, -9999, dtype=np.int32)
+
+        costs, predecessors = dijkstra(
+            self.csr(self.routable(positive_cost)),
+            indices=source,
+            return_predecessors=True,
+        )
+        costs.flags.writeable = False
+        predecessors.flags.writeable = False
+
+        return costs, predecessors
+
+    def obstructed_start_costs(self, removed, positive_cost=False):
+        """
+        Aggregated cost from the START_NODE to all nodes when edges are
+        removed from the network, without traffic sign restrictions.
+
+        Removing edges only changes the cost of the nodes below the
+        removed edges in the shortest path tree (start_tree). Only those
+        nodes are routed again, starting from the edges which connect
+        them with the rest of the tree.
+        :param removed: boolean array - True for each removed edge
+        :param positive_cost: boolean - leave out edges with cost 0
+        :return: float array - cost per node index, inf if unreachable
+        """
+        costs, predecessors = self.start_tree(positive_cost)
+        mask = self.routable(positive_cost)
+        removed = removed & mask
+
+        # nodes which were reached over a removed edge
+        tree_edge = (
+            predecessors[self.targets[removed]] == self.sources[removed]
+        )
+        roots = np.unique(self.targets[removed][tree_edge])
+
+        if not len(roots):
+            return costs
+
+        n = len(self.node_ids)
+        affected = subtree_nodes(predecessors, roots)
+        is_affected = np.zeros(n, dtype=bool)
+        is_affected[affected] = True
+
+        mask &= ~removed
+        sources = self.sources[mask]
+        targets = self.targets[mask]
+        weights = self.cost[mask]
+
+        # the best cost at which each affected node can be reached from
+        # an unaffected node
+        entry = ~is_affected[sources] & is_affected[targets]
+        entry_costs = np.full(n, np.inf)
+        np.minimum.at(
+            entry_costs,
+            targets[entry],
+            costs[sources[entry]] + weights[entry],
+        )
+
+        # route over the affected nodes (0..k-1) from an extra node (k),
+        # connected to each affected node with its entry cost
+        k = len(affected)
+        local = np.full(n, -1, dtype=np.int64)
+        local[affected] = np.arange(k)
+
+        internal = is_affected[sources] & is_affected[targets]
+        entered = np.flatnonzero(np.isfinite(entry_costs[affected]))
+
+        local_costs = dijkstra(
+            edges_csr(
+                np.concatenate(
+                    (local[sources[internal]], np.full(len(entered), k))
+                ),
+                np.concatenate((local[targets[internal]], entered)),
+                np.concatenate(
+                    (weights[internal], entry_costs[affected][entered])
+                ),
+                k + 1,
+            ),
+            indices=k,
+        )
+
+        costs = costs.copy()
+        costs[affected] = local_costs[:k]
+
+        return costs
+
+    def _obstructed_unreachable_nodes(
+        self, road_element_ids, positive_cost=False
+    ):
+        """
+        Nodes which can not be reached from the START_NODE when road
+        elements are obstructed, without traffic sign restrictions.
+        Results are cached per set of obstructed road elements, use
+        obstructed_unreachable_nodes to call this.
+        :param road_element_ids: frozenset - ids of the obstructed road
+            elements (bereikbaarheid.out_vma_undirected.linknr)
+        :param positive_cost: boolean - leave out edges with cost 0
+        :return: int array - ids of the unreachable nodes, like
+            unreachable_nodes
+        """
+        removed = np.isin(
+            np.abs(self.edge_ids),
+            np.fromiter(road_element_ids, dtype=np.int64),
+        )
+        costs = self.obstructed_start_costs(removed, positive_cost)
+        unreached = ~np.isfinite(costs) | (self.node_ids == START_NODE)
+
+        unreachable = self.node_ids[unreached]
+        unreachable.flags.writeable = False
+
+        return unreachable
+
+    def snapshot_profiles(self):
+        """
+        The profiles which are precomputed in snapshots: the network
+        without traffic sign restrictions and the SNAPSHOT_VEHICLES, as
+        used for /roads/prohibitory (with margins and positive cost
+        edges) and /permits
+        :return: list of tuples - positive_cost and vehicle class
+        """
+        profiles = [(False, None), (True, None)]
+
+        for vehicle in SNAPSHOT_VEHICLES:
+            for positive_cost, margins in ((False, False), (True, True)):
+                profile = (positive_cost, self.vehicle_class(vehicle, margins))
+
+                if profile not in profiles:
+                    profiles.append(profile)
+
+        return profiles
+
+
+def index_edges(edge_ids, source_ids, target_ids):
+    """
+    Maps the node ids of edges to the indices 0..n-1 of the sorted node
+    ids, and sorts the edges by source node, so the outgoing edges of node
+    index i are the edges indptr[i] up to indptr[i + 1]
+    :param edge_ids: sequence of ints - id per edge
+    :param source_ids: sequence of ints - source node id per edge
+    :param target_ids: sequence of ints - target node id per edge
+    :return: EdgeIndex - order holds the original position of each sorted
+        edge, for sorting other edge attributes the same way
+    """
+    edge_ids = np.array(edge_ids, dtype=np.int64)
+    source_ids = np.array(source_ids, dtype=np.int64)
+    target_ids = np.array(target_ids, dtype=np.int64)
+
+    node_ids = np.union1d(source_ids, target_ids)
+    sources = np.searchsorted(node_ids, source_ids).astype(np.int32)
+    targets = np.searchsorted(node_ids, target_ids).astype(np.int32)
+    order = np.argsort(sources, kind="stable")
+
+    return EdgeIndex(
+        node_ids=node_ids,
+        indptr=np.concatenate(
+            ([0], np.bincount(sources, minlength=len(node_ids)).cumsum())
+        ),
+        order=order,
+        edge_ids=edge_ids[order],
+        sources=sources[order],
+        targets=targets[order],
+    )
+
+
+def find_node_index(node_ids, node_id):
+    """
+    :param node_ids: int array - sorted node ids, see index_edges
+    :param node_id: int - id of a node
+    :return: int - index of the node, or None if it is not in node_ids
+    """
+    i = np.searchsorted(node_ids, node_id)
+
+    if i < len(node_ids) and node_ids[i] == node_id:
+        return int(i)
+
+    return None
+
+
+def edges_csr(sources, targets, weights, n):
+    """
+    :param sources: int array - source node index per edge
+    :param targets: int array - target node index per edge
+    :param weights: float array - weight per edge
+    :param n: int - number of nodes
+    :return: scipy csr_matrix of the graph. Parallel edges are kept, so
+        routing uses the one with the lowest weight.
+    """
+    order = np.argsort(sources, kind="stable")
+    indptr = np.concatenate(
+        ([0], np.cumsum(np.bincount(sources, minlength=n)))
+    )
+
+    return csr_matrix((weights[order], targets[order], indptr), shape=(n, n))
+
+
+def subtree_nodes(predecessors, roots):
+    """
+    :param predecessors: int array - predecessor per node index in a
+        tree, negative for the root and nodes outside the tree
+    :param roots: int array - node indices
+    :return: int array - the roots and all their descendants
+    """
+    n = len(predecessors)
+    children = np.flatnonzero(predecessors >= 0)
+
+    # the children of each node, and of an extra node (n) the roots
+    tree = edges_csr(
+        np.concatenate((predecessors[children], np.full(len(roots), n))),
+        np.concatenate((children, roots)),
+        np.ones(len(children) + len(roots)),
+        n + 1,
+    )
+
+    return breadth_first_order(tree, n, return_predecessors=False)[1:]
+
+
+def snapshot_profile(stored):
+    """
+    Converts a profile read from a snapshot file to the profile used by
+    RoutingGraph.start_costs
+    :param stored: list - positive_cost and vehicle class (or None)
+    :return: tuple - positive_cost and VehicleClass (or None)
+    """
+    positive_cost, vehicle_class = stored
+
+    return (
+        positive_cost,
+        VehicleClass(*vehicle_class) if vehicle_class is not None else None,
+    )
+
+
+def write_graph_snapshot(graph, path):
+    """
+    Stores the arrays of a routing graph in a snapshot, with the
+    start_costs of its snapshot_profiles
+    :param graph: RoutingGraph
+    :param path: string - path of the snapshot
+    :return: int - the number of profiles
+    """
+    write_arrays(os.path.join(path, "graph"), graph.arrays)
+
+    profiles = graph.snapshot_profiles()
+    costs = np.empty((len(profiles), len(graph.node_ids)), dtype=np.float32)
+
+    for i, (positive_cost, vehicle_class) in enumerate(profiles):
+        costs[i] = graph.start_costs(vehicle_class, positive_cost)
+
+    write_reachability(
+        path,
+        [
+            [positive_cost, vehicle_class]
+            for positive_cost, vehicle_class in profiles
+        ],
+        costs,
+    )
+
+    return len(profiles)
+
+
+def read_graph_snapshot(path):
+    """
+    :param path: string - path of the snapshot
+    :return: RoutingGraph - with memory-mapped arrays, or None if the
+        snapshot can't be read
+    """
+    try:
+        graph = RoutingGraph(read_arrays(os.path.join(path, "graph")))
+    except (OSError, ValueError, KeyError) as error:
+        print("Error while reading routing graph snapshot: ", error)
+        return None
+
+    graph.snapshot = read_reachability(
+        path, len(graph.node_ids), snapshot_profile
+    )
+
+    return graph
+
+
+def query_graph():
+    """
+    Loads the routing graph from the database
+    :return: RoutingGraph
+    """
+    db_query = """
+        select id, source, target, cost,
+            c01, c07, c07a, c10,
+            c17, c18, c19, c20, c21
+        from bereikbaarheid.out_vma_directed
+    """
+
+    return RoutingGraph.from_rows(query_db(db_query, {}))
+
+
+def load_graph():
+    """
+    Loads the routing graph from the current snapshot if there is one
+    which was created from the current data, otherwise from the database
+    :return: RoutingGraph
+    """
+    directory = current_app.config["ROUTING_SNAPSHOT_DIR"]
+    path = current_snapshot(directory) if directory else None
+
+    if path and snapshot_is_current(path):
+        graph = read_graph_snapshot(path)
+
+        if graph is not None:
+            return graph
+
+    return query_graph()
+
+
+def get_graph():
+    """
+    Returns the routing graph of this process, loading it on first use,
+    and again when a new snapshot is published.
+    Must be called within an application context.
+    :return: RoutingGraph
+    """
+    global _graph, _graph_snapshot
+
+    loaded = _graph
+    snapshot = current_snapshot_mtime(
+        current_app.config["ROUTING_SNAPSHOT_DIR"]
+    )
+
+    if loaded is None or snapshot != _graph_snapshot:
+        with _graph_lock:
+            if _graph is None or snapshot != _graph_snapshot:
+                _graph = load_graph()
+                _graph_snapshot = snapshot
+
+            loaded = _graph
+
+    return loaded
+
+
+def reset_graph():
+    """
+    Discards the routing graph, it is loaded again on next use
+    """
+    global _graph
+
+    with _graph_lock:
+        _graph = None
+
+
+on_invalidate(reset_graph, tables=["out_vma_directed"])
@@ -0,0 +1,221 @@
+from datetime import datetime
+import fcntl
+import glob
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+from ..data_version import query_table_versions
+from ..db import get_db
+
+# A snapshot is a directory with the routing data as NumPy arrays, which
+# are memory-mapped read-only so all worker processes share one copy and
+# can load the data without querying the database. The snapshot in use is
+# named in CURRENT_FILE, which is replaced once a new snapshot is complete.
+CURRENT_FILE = "current.json"
+SNAPSHOT_PREFIX = "snapshot-"
+LOCK_FILE = "publish.lock"
+
+# Tables (of the bereikbaarheid schema) the routing data is loaded from.
+# A snapshot is only used while their versions are the same as when the
+# snapshot was created, see data_version.query_table_versions.
+SOURCE_TABLES = ("out_vma_directed", "out_vma_node")
+
+
+class Snapshot:
+    """
+    Precomputed aggregated costs from the start node to all nodes of a
+    routing graph, for several routing profiles
+    """
+
+    def __init__(self, profiles, costs):
+        """
+        :param profiles: list of hashable profiles, one per row of costs
+        :param costs: float array - cost per profile and node index
+        """
+        self.rows = {profile: i for i, profile in enumerate(profiles)}
+        self.costs = costs
+
+    def profile_costs(self, profile):
+        """
+        :param profile: a hashable profile
+        :return: float array - cost per node index, inf if unreachable,
+            or None if the profile is not in the snapshot
+        """
+        row = self.rows.get(profile)
+
+        if row is None:
+            return None
+
+        return self.costs[row]
+
+
+def current_snapshot(directory):
+    """
+    :param directory: string - directory of the snapshots
+    :return: string - path of the current snapshot, or None
+    """
+    try:
+        with open(os.path.join(directory, CURRENT_FILE)) as f:
+            name = json.load(f)["snapshot"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+    return os.path.join(directory, name)
+
+
+def current_snapshot_mtime(directory):
+    """
+    :param directory: string - directory of the snapshots, or None
+    :return: int - modification time (in nanoseconds) of CURRENT_FILE,
+        which changes when a new snapshot is published, or None if there
+        is no current snapshot
+    """
+    if not directory:
+        return None
+
+    try:
+        return os.stat(os.path.join(directory, CURRENT_FILE)).st_mtime_ns
+    except OSError:
+        return None
+
+
+def query_source_versions():
+    """
+    Must be called within an application context.
+    :return: dict - the current version per SOURCE_TABLES table
+    """
+    versions = query_table_versions(get_db())
+
+    return {table: versions.get(table) for table in SOURCE_TABLES}
+
+
+def snapshot_is_current(path):
+    """
+    Checks if a snapshot was created from the current data, so it is not
+    used after the materialized views are refreshed
+    :param path: string - path of the snapshot
+    :return: boolean - False if the source tables have changed, or if
+        this can't be checked
+    """
+    try:
+        with open(os.path.join(path, "sources.json")) as f:
+            sources = json.load(f)["versions"]
+
+        if sources == query_source_versions():
+            return True
+
+    except Exception as error:
+        print("Error while checking the routing snapshot: ", error)
+        return False
+
+    print("The routing snapshot is outdated, it is not used")
+    return False
+
+
+def write_sources(path, versions):
+    """
+    :param path: string - path of the snapshot
+    :param versions: dict - the versions of the SOURCE_TABLES from before
+        the routing data was loaded, see query_source_versions
+    """
+    with open(os.path.join(path, "sources.json"), "w") as f:
+        json.dump({"versions": versions}, f)
+
+
+def publish_snapshot(directory, write):
+    """
+    Creates a new snapshot and makes it the current one. Older snapshots
+    are removed, processes which mapped them can keep using them.
+    :param directory: string - directory of the snapshots
+    :param write: function - writes the data, given the snapshot path
+    :return: string - path of the new snapshot
+    """
+    created = datetime.now().strftime("%Y%m%d%H%M%S")
+    name = f"{SNAPSHOT_PREFIX}{created}-{uuid.uuid4().hex[:8]}"
+    path = os.path.join(directory, name)
+
+    os.makedirs(f"{path}.tmp")
+    write(f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+
+    # publishing is serialized, so overlapping runs can't remove the
+    # snapshot the other run made current
+    with open(os.path.join(directory, LOCK_FILE), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        current = os.path.join(directory, CURRENT_FILE)
+        with open(f"{current}.{uuid.uuid4().hex}.tmp", "w") as f:
+            json.dump({"snapshot": name}, f)
+        os.replace(f.name, current)
+
+        # snapshots which are still being written by other runs are kept
+        for old in glob.glob(os.path.join(directory, f"{SNAPSHOT_PREFIX}*")):
+            if old != path and not old.endswith(".tmp"):
+                shutil.rmtree(old, ignore_errors=True)
+
+    return path
+
+
+def write_arrays(path, arrays):
+    """
+    :param path: string - directory to store the arrays in
+    :param arrays: dict of NumPy arrays
+    """
+    os.makedirs(path, exist_ok=True)
+
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), array)
+
+
+def read_arrays(path):
+    """
+    :param path: string - directory with arrays stored by write_arrays
+    :return: dict of read-only memory-mapped arrays
+    """
+    return {
+        os.path.basename(i)[:-4]: np.load(i, mmap_mode="r")
+        for i in glob.glob(os.path.join(path, "*.npy"))
+    }
+
+
+def write_reachability(path, profiles, costs):
+    """
+    :param path: string - path of the snapshot
+    :param profiles: list of JSON serializable profiles
+    :param costs: float array - cost per profile and node index
+    """
+    np.save(
+        os.path.join(path, "reachability.npy"),
+        np.ascontiguousarray(costs, dtype=np.float32),
+    )
+
+    with open(os.path.join(path, "reachability.json"), "w") as f:
+        json.dump({"profiles": profiles}, f)
+
+
+def read_reachability(path, node_count, profile_key):
+    """
+    :param path: string - path of the snapshot
+    :param node_count: int - number of nodes of the routing graph
+    :param profile_key: function - converts a stored profile to the
+        hashable profile used for lookups
+    :return: Snapshot, or None if the snapshot has no (valid) reachability
+    """
+    try:
+        with open(os.path.join(path, "reachability.json")) as f:
+            profiles = json.load(f)["profiles"]
+
+        costs = np.load(os.path.join(path, "reachability.npy"), mmap_mode="r")
+    except (OSError, ValueError, KeyError) as error:
+        print("No reachability in snapshot: ", error)
+        return None
+
+    if costs.shape != (len(profiles), node_count):
+        print("Reachability snapshot does not match the routing graph")
+        return None
+
+    return Snapshot([profile_key(i) for i in profiles], costs)
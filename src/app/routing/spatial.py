@@ -0,0 +1,306 @@
+from collections import namedtuple
+import os
+import threading
+
+from flask import current_app
+import numpy as np
+from pyproj import Transformer
+from scipy.spatial import cKDTree
+
+from ..cache import on_invalidate
+from ..db import query_db
+from .snapshot import (
+    current_snapshot,
+    current_snapshot_mtime,
+    read_arrays,
+    snapshot_is_current,
+    write_arrays,
+)
+
+# Edges are split into pieces of at most this length (in meters) so the
+# midpoints of the pieces can be used to find the closest edge
+PIECE_LENGTH = 25
+
+# Result of snapping a location to the network: the id of the closest
+# node or edge and the distance to it in meters
+Snap = namedtuple("Snap", ["id", "distance"])
+
+_index = None
+_index_snapshot = None
+_index_lock = threading.Lock()
+_transformers = threading.local()
+
+
+def to_rd(lat, lon):
+    """
+    Converts a WGS84 location to RD New (EPSG:28992) coordinates
+    :param lat: float - the latitude of the location
+    :param lon: float - the longitude of the location
+    :return: tuple - x and y in meters
+    """
+    # Transformer objects should not be shared between threads
+    if not hasattr(_transformers, "rd"):
+        _transformers.rd = Transformer.from_crs(
+            "EPSG:4326", "EPSG:28992", always_xy=True
+        )
+
+    return _transformers.rd.transform(lon, lat)
+
+
+class SpatialIndex:
+    """
+    Finds the node (bereikbaarheid.out_vma_node) or road element
+    (bereikbaarheid.out_vma_directed with id > 0) closest to a location,
+    with distances in RD New (EPSG:28992) coordinates.
+    """
+
+    def __init__(self, arrays):
+        # the pieces are stored with the other arrays, so snapshots
+        # include them
+        if "piece_edges" not in arrays:
+            piece_edges, piece_start, piece_end = split_lines(
+                arrays["edge_offsets"], arrays["edge_xy"]
+            )
+            arrays = dict(
+                arrays,
+                piece_edges=piece_edges,
+                piece_start=piece_start,
+                piece_end=piece_end,
+            )
+
+        self.arrays = arrays
+
+        self.node_ids = arrays["node_ids"]
+        self.node_tree = cKDTree(arrays["node_xy"])
+
+        self.edge_ids = arrays["edge_ids"]
+        self.piece_edges = arrays["piece_edges"]
+        self.piece_start = arrays["piece_start"]
+        self.piece_end = arrays["piece_end"]
+        self.piece_tree = cKDTree((self.piece_start + self.piece_end) / 2)
+        self.max_half_length = (
+            np.hypot(*(self.piece_end - self.piece_start).T).max() / 2
+            if len(self.piece_edges)
+            else 0
+        )
+
+    def nearest_node(self, lat, lon):
+        """
+        :param lat: float - the latitude of the location
+        :param lon: float - the longitude of the location
+        :return: Snap - the closest node
+        """
+        distance, i = self.node_tree.query(to_rd(lat, lon))
+
+        return Snap(int(self.node_ids[i]), float(distance))
+
+    def nearest_edge(self, lat, lon, mask=None):
+        """
+        :param lat: float - the latitude of the location
+        :param lon: float - the longitude of the location
+        :param mask: boolean array - optional, only consider the edges
+            for which the mask (indexed like edge_ids) is True
+        :return: Snap - the closest road element, or None if no road
+            element qualifies
+        """
+        if not len(self.piece_edges):
+            return None
+
+        point = np.array(to_rd(lat, lon))
+
+        # A piece can't be closer than the distance to its midpoint minus
+        # half its length, and the closest piece is at most as far away
+        # as the closest midpoint.
+        nearest_midpoint, _ = self.piece_tree.query(point)
+        candidates = np.array(
+            self.piece_tree.query_ball_point(
+                point, nearest_midpoint + self.max_half_length
+            ),
+            dtype=np.int64,
+        )
+
+        if mask is not None:
+            candidates = candidates[mask[self.piece_edges[candidates]]]
+
+            if not len(candidates):
+                candidates = np.flatnonzero(mask[self.piece_edges])
+
+        if not len(candidates):
+            return None
+
+        distances = point_to_segments(
+            point, self.piece_start[candidates], self.piece_end[candidates]
+        )
+        closest = candidates[np.argmin(distances)]
+
+        return Snap(
+            int(self.edge_ids[self.piece_edges[closest]]),
+            float(distances.min()),
+        )
+
+
+def split_lines(offsets, coordinates):
+    """
+    Splits lines into straight pieces of at most PIECE_LENGTH meters
+    :param offsets: int array - the coordinates of line i are
+        coordinates[offsets[i]:offsets[i + 1]]
+    :param coordinates: float array - x, y of the vertices of all lines
+    :return: tuple of arrays - line index, start and end point per piece
+    """
+    line_of_vertex = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    is_segment = line_of_vertex[:-1] == line_of_vertex[1:]
+
+    segment_lines = line_of_vertex[:-1][is_segment]
+    start = coordinates[:-1][is_segment]
+    vector = coordinates[1:][is_segment] - start
+
+    lengths = np.hypot(*vector.T)
+    pieces = np.maximum(np.ceil(lengths / PIECE_LENGTH), 1).astype(np.int64)
+    segment = np.repeat(np.arange(len(pieces)), pieces)
+    piece = np.arange(len(segment)) - np.repeat(
+        np.cumsum(pieces) - pieces, pieces
+    )
+    fraction_start = (piece / pieces[segment])[:, None]
+    fraction_end = ((piece + 1) / pieces[segment])[:, None]
+
+    return (
+        segment_lines[segment],
+        start[segment] + vector[segment] * fraction_start,
+        start[segment] + vector[segment] * fraction_end,
+    )
+
+
+def point_to_segments(point, start, end):
+    """
+    :param point: float array - x, y of a point
+    :param start: float array - x, y of the start point of each segment
+    :param end: float array - x, y of the end point of each segment
+    :return: float array - the distance from the point to each segment
+    """
+    vector = end - start
+    squared_length = (vector**2).sum(axis=1)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = ((point - start) * vector).sum(axis=1) / squared_length
+
+    t = np.clip(np.nan_to_num(t), 0, 1)[:, None]
+
+    return np.hypot(*(point - (start + t * vector)).T)
+
+
+def write_spatial_snapshot(index, path):
+    """
+    :param index: SpatialIndex
+    :param path: string - path of the snapshot
+    """
+    write_arrays(os.path.join(path, "spatial"), index.arrays)
+
+
+def read_spatial_snapshot(path):
+    """
+    :param path: string - path of the snapshot
+    :return: SpatialIndex - with memory-mapped arrays, or None if the
+        snapshot can't be read
+    """
+    try:
+        return SpatialIndex(read_arrays(os.path.join(path, "spatial")))
+    except (OSError, ValueError, KeyError) as error:
+        print("Error while reading spatial index snapshot: ", error)
+
+
+def query_spatial_index():
+    """
+    Loads the node and road element coordinates from the database
+    :return: SpatialIndex
+    """
+    nodes = query_db(
+        """
+        select node, st_x(geom_28992), st_y(geom_28992)
+        from bereikbaarheid.out_vma_node
+        """,
+        {},
+    )
+
+    vertices = query_db(
+        """
+        select a.id, st_x(p.geom), st_y(p.geom)
+        from bereikbaarheid.out_vma_directed a,
+            st_dumppoints(st_linemerge(a.geom)) p
+        where a.id > 0
+        order by a.id, p.path
+        """,
+        {},
+    )
+
+    vertex_edges = np.array([i[0] for i in vertices], dtype=np.int64)
+    edge_ids, first_vertex = np.unique(vertex_edges, return_index=True)
+
+    return SpatialIndex(
+        {
+            "node_ids": np.array([i[0] for i in nodes], dtype=np.int64),
+            "node_xy": np.array(
+                [i[1:] for i in nodes], dtype=np.float64
+            ).reshape(-1, 2),
+            "edge_ids": edge_ids,
+            "edge_offsets": np.append(first_vertex, len(vertex_edges)),
+            "edge_xy": np.array(
+                [i[1:] for i in vertices], dtype=np.float64
+            ).reshape(-1, 2),
+        }
+    )
+
+
+def load_spatial_index():
+    """
+    Loads the spatial index from the current snapshot if there is one
+    which was created from the current data, otherwise from the database
+    :return: SpatialIndex
+    """
+    directory = current_app.config["ROUTING_SNAPSHOT_DIR"]
+    path = current_snapshot(directory) if directory else None
+
+    if path and snapshot_is_current(path):
+        index = read_spatial_snapshot(path)
+
+        if index is not None:
+            return index
+
+    return query_spatial_index()
+
+
+def get_spatial_index():
+    """
+    Returns the spatial index of this process, loading it on first use,
+    and again when a new snapshot is published.
+    Must be called within an application context.
+    :return: SpatialIndex
+    """
+    global _index, _index_snapshot
+
+    loaded = _index
+    snapshot = current_snapshot_mtime(
+        current_app.config["ROUTING_SNAPSHOT_DIR"]
+    )
+
+    if loaded is None or snapshot != _index_snapshot:
+        with _index_lock:
+            if _index is None or snapshot != _index_snapshot:
+                _index = load_spatial_index()
+                _index_snapshot = snapshot
+
+            loaded = _index
+
+    return loaded
+
+
+def reset_spatial_index():
+    """
+    Discards the spatial index, it is loaded again on next use
+    """
+    global _index
+
+    with _index_lock:
+        _index = None
+
+
+on_invalidate(reset_spatial_index, tables=["out_vma_directed", "out_vma_node"])
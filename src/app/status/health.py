@@ -1,8 +1,15 @@
-from flask import make_response
+from flask import current_app, make_response
 
 from . import status
+from .. import warmup
 
 
 @status.route("health")
 def health_check():
+    # the worker is not ready while the caches are warming up
+    if not warmup.is_ready(current_app):
+        return make_response(
+            {"status": "WARMING_UP", "content": "Warming up caches"}, 503
+        )
+
     return make_response({"status": "OK", "content": "OK"}, 200)
@@ -0,0 +1,126 @@
+import os
+import threading
+from urllib.parse import urlencode
+
+from .routing.graph import SNAPSHOT_VEHICLES
+
+# The warm-up runs once per (forked) worker process
+_warmup = None
+_warmup_pid = None
+_ready = threading.Event()
+_lock = threading.Lock()
+
+
+def vehicle_type(vehicle):
+    """
+    :param vehicle: routing.Vehicle
+    :return: string - the vehicleType API parameter of the vehicle
+    """
+    if vehicle.is_bus:
+        return "Bus"
+
+    if vehicle.is_company_car:
+        return "Bedrijfsauto"
+
+    return "Personenauto"
+
+
+def warmup_urls():
+    """
+    The requests which are made during the warm-up: the prohibitory roads
+    of the common vehicles (the routing.graph.SNAPSHOT_VEHICLES, without
+    permits), today's road obstructions and the load unload data
+    :return: list of strings - URLs of the requests
+    """
+    urls = []
+
+    for vehicle in SNAPSHOT_VEHICLES:
+        query = {
+            "permitLowEmissionZone": "false",
+            "permitZzv": "false",
+            "vehicleAxleWeight": vehicle.axle_weight,
+            "vehicleHasTrailer": str(vehicle.has_trailer).lower(),
+            "vehicleHeight": vehicle.height,
+            "vehicleLength": vehicle.length,
+            "vehicleMaxAllowedWeight": vehicle.max_allowed_weight,
+            "vehicleTotalWeight": vehicle.total_weight,
+            "vehicleType": vehicle_type(vehicle),
+            "vehicleWidth": vehicle.width,
+        }
+        urls.append(f"/v1/roads/prohibitory?{urlencode(query)}")
+
+    urls.append("/v1/road-obstructions/")
+    urls.append("/v1/road-sections/load-unload/")
+
+    return urls
+
+
+def warm_up(app):
+    """
+    Fills the caches of the worker by requesting the warmup_urls. The
+    routing data is loaded by these requests as well. The worker is ready
+    afterwards, also if requests failed.
+    :param app: the Flask app
+    """
+    try:
+        client = app.test_client()
+
+        for url in warmup_urls():
+            response = client.get(url)
+
+            if response.status_code != 200:
+                print(
+                    f"Warm-up request failed ({response.status_code}): {url}"
+                )
+
+    except Exception as error:
+        print("Error while warming up: ", error)
+
+    finally:
+        _ready.set()
+
+
+def start_warmup(app):
+    """
+    Starts the warm-up in a background thread, if enabled with WARMUP
+    :param app: the Flask app
+    """
+    global _warmup, _warmup_pid
+
+    if not app.config["WARMUP"]:
+        return
+
+    if _warmup is not None and _warmup_pid == os.getpid():
+        return
+
+    with _lock:
+        if _warmup is None or _warmup_pid != os.getpid():
+            _ready.clear()
+            _warmup = threading.Thread(
+                target=warm_up, args=(app,), daemon=True
+            )
+            _warmup_pid = os.getpid()
+            _warmup.start()
+
+
+def is_ready(app):
+    """
+    :param app: the Flask app
+    :return: boolean - False while the worker is warming up
+    """
+    if not app.config["WARMUP"]:
+        return True
+
+    return _warmup_pid == os.getpid() and _ready.is_set()
+
+
+def init_app(app):
+    """Warm up the caches of the Flask app. Under gunicorn the warm-up
+    starts when a worker has booted, see gunicorn.conf.py. Otherwise, and
+    as fallback, it starts with the first request of a worker. This is
+    called by the application factory.
+    """
+
+    @app.before_request
+    def start_warmup_thread():
+        start_warmup(app)
@@ -0,0 +1,11 @@
+# Gunicorn settings, used by start_app.sh
+
+
+def post_worker_init(worker):
+    """Start the warm-up of a worker as soon as it has loaded the app,
+    instead of with its first request. Otherwise a worker which has not
+    been reached by a health check yet would warm up on a user request.
+    """
+    from app import warmup
+
+    warmup.start_warmup(worker.wsgi)
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from app.routing.graph import START_NODE, RoutingGraph
+
+
+def random_graph(rng, n=40, m=120):
+    """
+    :param rng: numpy random Generator
+    :param n: int - number of nodes, one of them the START_NODE
+    :param m: int - number of edges
+    :return: RoutingGraph - with zero cost, unroutable and parallel edges
+    """
+    node_ids = np.concatenate(([START_NODE], rng.choice(10**6, n - 1)))
+    sources = rng.choice(node_ids, m)
+    targets = rng.choice(node_ids, m)
+
+    cost = rng.integers(0, 10, m).astype(float)
+    cost[rng.random(m) < 0.05] = -1
+    cost[rng.random(m) < 0.05] = np.nan
+
+    # parallel edges
+    sources[-10:] = sources[:10]
+    targets[-10:] = targets[:10]
+
+    rows = [
+        (i + 1, int(sources[i]), int(targets[i]), cost[i])
+        + (False,) * 4
+        + (None,) * 5
+        for i in range(m)
+    ]
+
+    return RoutingGraph.from_rows(rows)
+
+
+@pytest.mark.parametrize("seed", range(50))
+@pytest.mark.parametrize("positive_cost", [False, True])
+def test_obstructed_start_costs(seed, positive_cost):
+    rng = np.random.default_rng(seed)
+    graph = random_graph(rng)
+
+    for fraction in (0, 0.05, 0.2, 0.5):
+        removed = rng.random(len(graph.edge_ids)) < fraction
+
+        expected = graph.dijkstra_cost(
+            START_NODE, graph.routable(positive_cost) & ~removed
+        )
+
+        np.testing.assert_allclose(
+            graph.obstructed_start_costs(removed, positive_cost), expected
+        )
+
+
+def test_obstructed_start_costs_without_start_node():
+    graph = RoutingGraph.from_rows(
+        [(1, 1, 2, 1.0) + (False,) * 4 + (None,) * 5]
+    )
+    removed = np.array([True])
+
+    assert np.isinf(graph.obstructed_start_costs(removed)).all()
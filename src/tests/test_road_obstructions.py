@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from app.api.road_obstructions import ObstructionIndex
+
+BASE_DATE = datetime(2023, 6, 1)
+
+
+def random_date(rng):
+    """
+    :param rng: numpy random Generator
+    :return: datetime - in a few days after BASE_DATE, rounded to the
+        hour, so windows often start or end at a start or end date
+    """
+    return BASE_DATE + timedelta(hours=int(rng.integers(0, 96)))
+
+
+def expected_obstructions(start_dates, end_dates, time_from, time_to):
+    """
+    The obstructions the road obstructions query selects, obstructions
+    without a start or end date are not active
+    """
+    return tuple(
+        i
+        for i, (start, end) in enumerate(zip(start_dates, end_dates))
+        if start is not None
+        and end is not None
+        and start <= time_to
+        and end >= time_from
+    )
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_active_obstructions(seed):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(0, 30))
+
+    start_dates = [random_date(rng) for _ in range(n)]
+    end_dates = [
+        start + timedelta(hours=int(rng.integers(0, 48)))
+        for start in start_dates
+    ]
+
+    for i in range(n):
+        if rng.random() < 0.1:
+            start_dates[i] = None
+        if rng.random() < 0.1:
+            end_dates[i] = None
+
+    index = ObstructionIndex(list(range(n)), start_dates, end_dates)
+
+    for _ in range(100):
+        time_from = random_date(rng)
+        time_to = time_from + timedelta(hours=int(rng.integers(0, 24)))
+
+        assert index.active_obstructions(
+            time_from, time_to
+        ) == expected_obstructions(start_dates, end_dates, time_from, time_to)
+
+
+def test_interval_moments():
+    index = ObstructionIndex(
+        [1, 2],
+        [datetime(2023, 6, 1, 8), datetime(2023, 6, 1, 12)],
+        [datetime(2023, 6, 1, 10), datetime(2023, 6, 1, 16)],
+    )
+
+    assert index.interval_moments(
+        datetime(2023, 6, 1, 6), datetime(2023, 6, 1, 14)
+    ) == [
+        datetime(2023, 6, 1, 7),
+        datetime(2023, 6, 1, 9),
+        datetime(2023, 6, 1, 11),
+        datetime(2023, 6, 1, 13),
+    ]
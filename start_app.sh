@@ -6,5 +6,5 @@ FLASK_ENV="${FLASK_ENV:=production}"
 if [ "$FLASK_ENV" = "development" ]; then
   python -m flask run --host=0.0.0.0 --port=8000
 elif [ "$FLASK_ENV" = "production" ]; then
-  gunicorn --chdir /app/src "app:create_app()" -w 2 --threads 2 -b 0.0.0.0:8000
+  gunicorn --chdir /app/src -c /app/src/gunicorn.conf.py "app:create_app()" -w 2 --threads 2 -b 0.0.0.0:8000
 fi